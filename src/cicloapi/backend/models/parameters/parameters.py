@@ -4,6 +4,25 @@ poi_source = "grid"  # railwaystation, grid
 prune_measure = "betweenness"  # betweenness, clo seness, random
 
 SERVER = False  # Whether the code runs on the server (important to avoid parallel job conflicts)
+graph_cache_mb = 2048  # Memory budget (MB) of the cache of loaded graphs, 0 disables it
+compression_codec = "zip"  # Setup CSV codec: zip, zstd or lz4 (extras [zstd], [lz4])
+compression_workers = 8  # Number of threads compressing the setup CSVs
+distance_workers = 0  # Processes computing POI distance matrices, 0 uses all cores
+distance_parallel_min_sources = 200  # Fewer source POIs than this run serially
+# GT candidate pairs: all, delaunay, knn or delaunay+knn. Pruned candidates are only
+# exact with gt_candidates_verify, which makes them as slow as all; without it they
+# give a quick approximate GT (some long edges missed), e.g. for previews.
+gt_candidates = "all"
+gt_candidates_k = 10  # Pairs per POI kept by the knn candidates
+gt_candidates_verify = True  # Repair pruned GT candidates to equal all
+connectivity_parallel = True  # Route GTs and MST in two processes (no shared paths)
+routing_graph = "full"  # Routing graph of POIs: full, contracted (chains) or ch
+# Store distances between all H3 candidate nodes of a city per zoom. Off by default:
+# the first /run of a city and zoom computes them (8*n^2 bytes on disk).
+candidate_distances = False
+candidate_distances_max = 10000  # More candidates are not stored (8*n^2 bytes)
+result_cache_mb = 4096  # Disk budget (MB) of the cache of /run results, 0 disables it
+result_cache_max_age_days = 30  # Cached /run results older than this are recomputed
 
 
 # SEMI-CONSTANTS
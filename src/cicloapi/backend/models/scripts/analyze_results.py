@@ -18,7 +18,7 @@ from shapely.geometry import Polygon
 
 # Local
 from cicloapi.backend.models.scripts.functions import (
-    csv_to_ig,
+    load_city_bundle,
     calculate_metrics_parallel,
     delete_overlaps,
     intersect_igraphs,
@@ -103,17 +103,19 @@ def main(
             }
 
             # Analyze all networks
-            Gs = {}
+            Gs = load_city_bundle(
+                PATH["data"] / placeid,
+                placeid,
+                [
+                    networktype + postfix
+                    for networktype in networktypes
+                    if networktype not in ["biketrack_onstreet", "bikeable_offstreet"]
+                    for postfix in ["", "_simplified"]
+                ],
+            )
             for networktype in networktypes:
                 logger.info(f"{placeid}: Processing network type: {networktype}")
-                if networktype not in ["biketrack_onstreet", "bikeable_offstreet"]:
-                    Gs[networktype] = csv_to_ig(
-                        PATH["data"] / placeid, placeid, networktype
-                    )
-                    Gs[networktype + "_simplified"] = csv_to_ig(
-                        PATH["data"] / placeid, placeid, networktype + "_simplified"
-                    )
-                elif networktype == "biketrack_onstreet":
+                if networktype == "biketrack_onstreet":
                     Gs[networktype] = intersect_igraphs(Gs["biketrack"], Gs["carall"])
                     Gs[networktype + "_simplified"] = intersect_igraphs(
                         Gs["biketrack_simplified"], Gs["carall_simplified"]
@@ -137,11 +139,10 @@ def main(
     for placeid, placeinfo in cities.items():
         logger.info(f"{placeid}: Analyzing results")
 
-        G_carall = csv_to_ig(PATH["data"] / placeid, placeid, "carall")
-        Gexisting = {
-            networktype: csv_to_ig(PATH["data"] / placeid, placeid, networktype)
-            for networktype in ["biketrack", "bikeable"]
-        }
+        Gexisting = load_city_bundle(
+            PATH["data"] / placeid, placeid, ["carall", "biketrack", "bikeable"]
+        )
+        G_carall = Gexisting.pop("carall")
 
         # Load POIs
         logger.info(f"{placeid}: Loading POIs for results analysis")
@@ -156,6 +157,13 @@ def main(
 
         with open(resultfile_path, "rb") as resultfile:
             res = pickle.load(resultfile)
+        missing = [family for family in ["GTs", "MST"] if family not in res]
+        if missing:
+            # Runs with connectivity_only compute a single family
+            logger.error(
+                f"{placeid}: No {' and '.join(missing)} results, add them with /run and task_id {task_id}"
+            )
+            continue
 
         # Calculate metrics
         logger.info(f"{placeid}: Calculating metrics additively")
@@ -40,6 +40,7 @@ from cicloapi.backend.models.scripts.functions import (
     extract_relevant_polygon,
     csv_to_ox,
     convert_to_h3,
+    write_candidate_distances,
 )
 from cicloapi.backend.models.parameters.parameters import (
     sanidad,
@@ -49,6 +50,7 @@ from cicloapi.backend.models.parameters.parameters import (
     cultura,
     deporte,
     transporte,
+    candidate_distances,
 )
 
 from cicloapi.database.database_models import SessionLocal
@@ -378,6 +380,22 @@ def main(
 
             logger.info(f"Saved snapped node IDs for {placeid} to {nnids_file}")
 
+            # Distances between the nodes of all hexagons, the exemplars of any
+            # sliders, so that runs at this zoom read them instead of routing
+            if candidate_distances:
+                try:
+                    write_candidate_distances(
+                        PATH["data"] / placeid,
+                        placeid,
+                        h3_zoom,
+                        gdf_hex["hex_id"],
+                        gdf_hex["centroid"],
+                        G_carall,
+                        snapthreshold,
+                    )
+                except Exception as e:
+                    logger.error(f"Error storing candidate distances for {placeid}: {e}")
+
         except Exception as e:
             logger.error(f"Error processing network for {placeid}: {e}")
 
@@ -2,21 +2,41 @@ from pathlib import Path
 from cicloapi.backend.models.scripts.path import PATH
 
 # from scripts.initialize import *
-from cicloapi.backend.models.parameters.parameters import SERVER, plotparam
+from cicloapi.backend.models.parameters.parameters import (
+    plotparam,
+    graph_cache_mb,
+    distance_workers,
+    distance_parallel_min_sources,
+    gt_candidates,
+    gt_candidates_k,
+    gt_candidates_verify,
+    result_cache_mb,
+    result_cache_max_age_days,
+    candidate_distances_max,
+)
 
 # System
 import copy
 import csv
+import hashlib
+import heapq
+import io
 import os
 import pickle
 import json
 import itertools
 import random
+import shutil
+import threading
+import time
+import weakref
 import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
 from tqdm import tqdm
 
-from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import Manager, shared_memory
 
 # Math/Data
 import math
@@ -333,16 +353,35 @@ def project_pos(lats, lons, map_center=False):
     return pos_transformed, (loncenter, latcenter)
 
 
+def round_array(values, r=7) -> np.ndarray:
+    """Round an array like Python's round(value, r) does, element by element.
+    np.round can pick the other neighbour when value*10**r lies within an ulp
+    of a half, so those few ties are rounded with round() instead.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scaled = values * 10.0**r
+    rounded = np.round(values, r)
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    rounded[ties] = [round(value, r) for value in values[ties].tolist()]
+    return rounded
+
+
+def normalize_coordinates(x, y, r=7):
+    """Return the vertex coordinates igraph graphs work with: x and y rounded
+    to r decimals and y mirrored, as round_coordinates and mirror_y do.
+    """
+    return round_array(x, r), -round_array(y, r)
+
+
 def round_coordinates(G, r=7):
-    for v in G.vs:
-        G.vs[v.index]["x"] = round(G.vs[v.index]["x"], r)
-        G.vs[v.index]["y"] = round(G.vs[v.index]["y"], r)
+    if G.vcount():
+        G.vs["x"] = round_array(G.vs["x"], r).tolist()
+        G.vs["y"] = round_array(G.vs["y"], r).tolist()
 
 
 def mirror_y(G):
-    for v in G.vs:
-        y = G.vs[v.index]["y"]
-        G.vs[v.index]["y"] = -y
+    if G.vcount():
+        G.vs["y"] = (-np.asarray(G.vs["y"], dtype=np.float64)).tolist()
 
 
 def dist(v1, v2):
@@ -358,54 +397,132 @@ def dist_vector(v1_list, v2_list):
 
 
 def osm_to_ig(node, edge):
-    """Turns a node and edge dataframe into an igraph Graph."""
-
-    G = ig.Graph(directed=False)
-
-    x_coords = node["x"].tolist()
-    y_coords = node["y"].tolist()
-    ids = node["osmid"].tolist()
-    coords = []
-
-    for i in range(len(x_coords)):
-        G.add_vertex(x=x_coords[i], y=y_coords[i], id=ids[i])
-        coords.append((x_coords[i], y_coords[i]))
-
-    id_dict = dict(zip(G.vs["id"], np.arange(0, G.vcount()).tolist()))
-    coords_dict = dict(zip(np.arange(0, G.vcount()).tolist(), coords))
-
-    edge_list = []
-    edge_info = {}
-    edge_info["weight"] = []
-    edge_info["osmid"] = []
-    for i in range(len(edge)):
-        edge_list.append([id_dict.get(edge["u"][i]), id_dict.get(edge["v"][i])])
-        edge_info["weight"].append(round(edge["length"][i], 10))
-        edge_info["osmid"].append(edge["osmid"][i])
-
-    G.add_edges(
-        edge_list
-    )  # attributes = edge_info doesn't work although it should: https://igraph.org/python/doc/igraph.Graph-class.html#add_edges
-    for i in range(len(edge)):
-        G.es[i]["weight"] = edge_info["weight"][i]
-        G.es[i]["osmid"] = edge_info["osmid"][i]
-
-    G.simplify(combine_edges=max)
+    """Turns a node and edge dataframe into an igraph Graph.
+    The result is the same as adding every edge and calling
+    G.simplify(combine_edges=max), but built with array operations.
+    """
+
+    ids = node["osmid"].to_numpy(dtype=np.int64)
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+
+    def to_index(osmids):
+        pos = np.searchsorted(sorted_ids, osmids).clip(max=len(ids) - 1)
+        if not np.array_equal(sorted_ids[pos], osmids):
+            raise ValueError("Edge endpoint missing from the node table.")
+        return order[pos]
+
+    source = to_index(edge["u"].to_numpy(dtype=np.int64))
+    target = to_index(edge["v"].to_numpy(dtype=np.int64))
+    weight = np.round(edge["length"].to_numpy(dtype=np.float64), 10)
+    osmid = edge["osmid"].to_numpy()
+
+    # Undirected edges are stored as (min, max); drop loops and merge multi-edges
+    lo = np.minimum(source, target)
+    hi = np.maximum(source, target)
+    keep = lo != hi
+    lo, hi, weight, osmid = lo[keep], hi[keep], weight[keep], osmid[keep]
+    srt = np.lexsort((hi, lo))
+    lo, hi, weight, osmid = lo[srt], hi[srt], weight[srt], osmid[srt]
+    starts = np.flatnonzero(np.r_[True, (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])])
+
+    G = ig.Graph(
+        n=len(ids),
+        edges=np.column_stack((lo[starts], hi[starts])).tolist(),
+        directed=False,
+    )
+    G.vs["x"] = node["x"].tolist()
+    G.vs["y"] = node["y"].tolist()
+    G.vs["id"] = ids.tolist()
+    if len(starts):
+        G.es["weight"] = np.maximum.reduceat(weight, starts).tolist()
+        G.es["osmid"] = np.maximum.reduceat(osmid, starts).tolist()
     return G
 
 
-def compress_file(folder, filename):
+COMPRESSION_SUFFIXES = {"zip": ".zip", "zstd": ".csv.zst", "lz4": ".csv.lz4"}
+COMPRESSION_PACKAGES = {"zstd": "zstandard", "lz4": "lz4"}
+
+
+def check_compression_codec(codec: str):
+    """Raise ValueError for an unknown codec, and ImportError if the optional
+    package of codec is not installed (pip install cicloapi[zstd] or [lz4]).
+    """
+    if codec not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    package = COMPRESSION_PACKAGES.get(codec)
+    if package is not None:
+        try:
+            __import__(package)
+        except ImportError as e:
+            raise ImportError(
+                f"Compression codec {codec} needs the optional {package} package, "
+                f"install it with: pip install cicloapi[{codec}]"
+            ) from e
+
+
+def compress_file(folder, filename, codec: str = "zip") -> Path:
+    """Compress folder/filename.csv with codec ('zip', 'zstd' or 'lz4').
+    zstd and lz4 are much faster than zip DEFLATE but need the optional
+    zstandard / lz4 packages. The compressed file replaces those of the other
+    codecs, so a stale one cannot shadow it. Returns its path.
+    """
     file_path = Path(folder) / f"{filename}.csv"
-    compressed_file_path = Path(folder) / f"{filename}.zip"
+    final_path = Path(folder) / f"{filename}{COMPRESSION_SUFFIXES[codec]}"
+    # Written aside and renamed, so readers never see a partial file
+    compressed_file_path = final_path.with_name(
+        f".{final_path.name}.{os.getpid()}.{threading.get_ident()}"
+    )
 
-    # Compress the file
-    with open(file_path, "rb") as f_in:
+    if codec == "zip":
         with zipfile.ZipFile(compressed_file_path, "w", zipfile.ZIP_DEFLATED) as f_out:
             f_out.write(
                 file_path, arcname=file_path.name
             )  # Keep the original name within the zip
+    elif codec == "zstd":
+        import zstandard
+
+        with open(file_path, "rb") as f_in, open(compressed_file_path, "wb") as f_out:
+            zstandard.ZstdCompressor(threads=-1).copy_stream(f_in, f_out)
+    else:
+        import lz4.frame
+
+        with (
+            open(file_path, "rb") as f_in,
+            lz4.frame.open(compressed_file_path, "wb") as f_out,
+        ):
+            shutil.copyfileobj(f_in, f_out)
+
+    os.replace(compressed_file_path, final_path)
+    for other, suffix in COMPRESSION_SUFFIXES.items():
+        if other != codec:
+            (Path(folder) / f"{filename}{suffix}").unlink(missing_ok=True)
+
+    # print(f"Compressed: {file_path} -> {final_path}")
+    return final_path
 
-    # print(f"Compressed: {file_path} -> {compressed_file_path}")
+
+def compress_files(paths, codec: str = "zip", max_workers: int = None):
+    """Compress the given CSV files over a pool of threads (the codecs release
+    the GIL while compressing). Returns a dict path -> exception of the files
+    that could not be compressed.
+    """
+    check_compression_codec(codec)
+    paths = [Path(path) for path in paths]
+    errors = {}
+    if not paths:
+        return errors
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(compress_file, path.parent, path.stem, codec): path
+            for path in paths
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors[futures[future]] = e
+    return errors
 
 
 def ox_to_csv(
@@ -416,7 +533,15 @@ def ox_to_csv(
     postfix: str = "",
     compress: bool = True,
     verbose: bool = True,
+    binary: bool = True,
+    bundle: dict = None,
 ):
+    """Write G to the node and edge CSVs of placeid_parameterid+postfix in p
+    (and to the .npz graph if binary). If a bundle dict is given, the columnar
+    arrays are added to it under parameterid+postfix for write_city_bundle
+    instead of being written to a .npz. Returns the paths of the written CSVs
+    so the caller can compress them later if compress is False.
+    """
     # Set CRS if not already present
     if "crs" not in G.graph:
         G.graph["crs"] = (
@@ -445,174 +570,641 @@ def ox_to_csv(
     if compress:
         compress_file(p, f"{prefix}_edges")  # Use f-string for the filename
 
+    if bundle is not None:
+        bundle[f"{parameterid}{postfix}"] = ox_to_arrays(G)
+    elif binary:
+        ox_to_npz(G, p, placeid, parameterid, postfix)
+
     if verbose:
         print(f"{placeid}: Successfully wrote graph {parameterid}{postfix}")
 
+    return [node_file_path, edge_file_path]
 
-def check_extract_zip(p: Path, prefix: str) -> bool:
-    """Check if a zip file prefix+'_nodes.zip' and prefix+'_edges.zip'
-    is available at path p. If so, extract it and return True; otherwise, return False.
-    If you call this function, remember to clean up (i.e., delete the unzipped files)
-    after you are done like this:
 
-    if compress:
-        os.remove(p / f'{prefix}_nodes.csv')
-        os.remove(p / f'{prefix}_edges.csv')
+def _first_of_list(value):
+    """Return the first element of list-valued OSM attributes, the value otherwise."""
+    return value[0] if isinstance(value, list) else value
+
+
+def ox_to_arrays(G) -> dict:
+    """Turn a networkx graph into typed columnar arrays.
+    Holds node ids and coordinates, edge endpoints, lengths and osmids, which
+    is all csv_to_ig and csv_to_ox load from the CSV files, plus the
+    normalized igraph coordinates (node_ig_x, node_ig_y) so csv_to_ig does not
+    have to recompute them on every load.
     """
+    nodes = list(G.nodes(data=True))
+    edges = list(G.edges(data=True))
+
+    arrays = {
+        "node_osmid": np.array([n for n, _ in nodes], dtype=np.int64),
+        "node_x": np.array([d["x"] for _, d in nodes], dtype=np.float64),
+        "node_y": np.array([d["y"] for _, d in nodes], dtype=np.float64),
+        "edge_u": np.array([u for u, _, _ in edges], dtype=np.int64),
+        "edge_v": np.array([v for _, v, _ in edges], dtype=np.int64),
+        "edge_length": np.array(
+            [_first_of_list(d["length"]) for _, _, d in edges], dtype=np.float64
+        ),
+        "edge_osmid": np.array(
+            [_first_of_list(d["osmid"]) for _, _, d in edges], dtype=np.int64
+        ),
+    }
+    arrays["node_ig_x"], arrays["node_ig_y"] = normalize_coordinates(
+        arrays["node_x"], arrays["node_y"]
+    )
+    return arrays
 
-    nodes_zip = p / f"{prefix}_nodes.zip"
-    edges_zip = p / f"{prefix}_edges.zip"
 
-    try:  # Use zip files if available
-        with zipfile.ZipFile(nodes_zip, "r") as zfile:
-            zfile.extract(f"{prefix}_nodes.csv", p)
-        with zipfile.ZipFile(edges_zip, "r") as zfile:
-            zfile.extract(f"{prefix}_edges.csv", p)
-        return True
-    except FileNotFoundError:
-        print(f"Zip files not found: {nodes_zip}, {edges_zip}")
-        return False
-    except Exception as e:
-        print(f"An error occurred while extracting zip files: {e}")
-        return False
+def ox_to_npz(G, p: Path, placeid: str, parameterid: str, postfix: str = ""):
+    """Write a networkx graph to <prefix>_graph.npz as the arrays of ox_to_arrays."""
+    np.savez(p / f"{placeid}_{parameterid}{postfix}_graph.npz", **ox_to_arrays(G))
 
 
-def csv_to_ox(p: Path, placeid: str, parameterid: str) -> nx.MultiDiGraph:
-    """Load a networkx graph from _edges.csv and _nodes.csv
-    The edge file must have attributes u,v,osmid,length
-    The node file must have attributes y,x,osmid
-    Only these attributes are loaded.
+def read_graph_npz(p: Path, prefix: str):
+    """Read the columnar arrays written by ox_to_npz.
+    Returns None if there is no <prefix>_graph.npz at path p.
     """
-    prefix = f"{placeid}_{parameterid}"
-    compress = check_extract_zip(p, prefix)
+    npz_file = p / f"{prefix}_graph.npz"
+    if not npz_file.exists():
+        return None
+    with np.load(npz_file) as data:
+        return {key: data[key] for key in data.files}
 
-    edges_file = p / f"{prefix}_edges.csv"
-    nodes_file = p / f"{prefix}_nodes.csv"
 
-    # Load edges
-    lines = []
-    try:
-        with edges_file.open("r") as f:
-            header = f.readline().strip().split(",")
-            for line in csv.reader(
-                f,
-                quotechar='"',
-                delimiter=",",
-                quoting=csv.QUOTE_ALL,
-                skipinitialspace=True,
-            ):
-                line_list = [c.strip() for c in line]  # Trim whitespace
-                if len(line_list) < len(header):
-                    continue  # Skip lines with insufficient data
+BUNDLE_NODE_KEYS = ["node_osmid", "node_x", "node_y", "node_ig_x", "node_ig_y"]
+BUNDLE_EDGE_KEYS = ["edge_u", "edge_v", "edge_length", "edge_osmid"]
 
-                try:
-                    u = line_list[header.index("u")].rstrip(
-                        ","
-                    )  # Remove any trailing commas
-                    v = line_list[header.index("v")].rstrip(",")
-                    osmid = line_list[header.index("osmid")]
-                    length = line_list[header.index("length")]
-
-                    # Handle potential list data and empty values
-                    osmid = (
-                        str(eval(osmid)[0]) if isinstance(eval(osmid), list) else osmid
-                    )
-                    length = (
-                        str(eval(length)[0])
-                        if isinstance(eval(length), list)
-                        else length
-                    )
-
-                    # Build the line string
-                    line_string = f"{u} {v} {osmid} {length}"
-                    lines.append(line_string)
-
-                except (IndexError, SyntaxError, TypeError):
-                    continue  # Skip if evaluation fails
-
-        # Create the graph
-        G = nx.parse_edgelist(
-            lines,
-            nodetype=int,
-            data=(("osmid", int), ("length", float)),
-            create_using=nx.MultiDiGraph,
+
+def write_city_bundle(p: Path, placeid: str, graphs: dict):
+    """Write the columnar arrays of all network variants of a city (a dict
+    variant -> ox_to_arrays output, e.g. "carall_simplified") to the bundle
+    directory <placeid>_bundle in p. Nodes are stored once in a table shared
+    by all variants; each variant keeps the indices of its nodes into that
+    table and its edges, all concatenated into one .npy file per column, so
+    the bundle can be memory-mapped. manifest.json holds the variant slices.
+    """
+    variants = list(graphs)
+    node_columns = {}
+    for key, dtype in [
+        ("node_osmid", np.int64),
+        ("node_x", np.float64),
+        ("node_y", np.float64),
+    ]:
+        node_columns[key] = np.concatenate(
+            [np.empty(0, dtype=dtype)] + [graphs[v][key] for v in variants]
         )
-    except FileNotFoundError:
-        print(f"Error: The file {edges_file} does not exist.")
-        return None  # Or handle as appropriate
+    # Table rows are unique (osmid, x, y) triples, so no variant loses its coordinates
+    order = np.lexsort(
+        (node_columns["node_y"], node_columns["node_x"], node_columns["node_osmid"])
+    )
+    new_row = np.zeros(len(order), dtype=bool)
+    new_row[:1] = True
+    for values in node_columns.values():
+        values = values[order]
+        new_row[1:] |= values[1:] != values[:-1]
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(new_row) - 1
+    columns = {key: values[order][new_row] for key, values in node_columns.items()}
+    columns["node_ig_x"], columns["node_ig_y"] = normalize_coordinates(
+        columns["node_x"], columns["node_y"]
+    )
 
-    # Load nodes
-    values_x = {}
-    values_y = {}
+    manifest = {"placeid": placeid, "nodes": len(columns["node_osmid"]), "variants": {}}
+    edges = {key: [] for key in BUNDLE_EDGE_KEYS}
+    n_nodes = n_edges = 0
+    for variant in variants:
+        arrays = graphs[variant]
+        for key in BUNDLE_EDGE_KEYS:
+            edges[key].append(arrays[key])
+        n_v, n_e = len(arrays["node_osmid"]), len(arrays["edge_u"])
+        manifest["variants"][variant] = {
+            "nodes": [n_nodes, n_nodes + n_v],
+            "edges": [n_edges, n_edges + n_e],
+        }
+        n_nodes += n_v
+        n_edges += n_e
+    columns["variant_nodes"] = inverse
+    for key in BUNDLE_EDGE_KEYS:
+        dtype = np.float64 if key == "edge_length" else np.int64
+        columns[key] = np.concatenate([np.empty(0, dtype=dtype)] + edges[key])
+
+    # Each write goes to a new version directory; replacing the manifest that
+    # names it switches readers over atomically. The previous version is kept
+    # for readers that read the old manifest just before the switch.
+    bundle_dir = p / f"{placeid}_bundle"
+    bundle_dir.mkdir(parents=True, exist_ok=True)
     try:
-        with nodes_file.open("r") as f:
-            header = f.readline().strip().split(",")
-            for line in csv.reader(
-                f,
-                quotechar='"',
-                delimiter=",",
-                quoting=csv.QUOTE_ALL,
-                skipinitialspace=True,
-            ):
-                line_list = [c.strip() for c in line]  # Trim whitespace
-                if len(line_list) < len(header):
-                    continue  # Skip lines with insufficient data
+        with open(bundle_dir / "manifest.json") as f:
+            previous = json.load(f).get("version")
+    except (FileNotFoundError, ValueError):
+        previous = None
+    version = f"v{time.time_ns()}"
+    version_dir = bundle_dir / version
+    version_dir.mkdir()
+    for key, values in columns.items():
+        np.save(version_dir / f"{key}.npy", values)
+    manifest["version"] = version
+    partial = bundle_dir / f".manifest.{version}.json"
+    with open(partial, "w") as f:
+        json.dump(manifest, f)
+    os.replace(partial, bundle_dir / "manifest.json")
+
+    for entry in bundle_dir.iterdir():
+        if entry.is_dir() and entry.name not in (version, previous):
+            shutil.rmtree(entry, ignore_errors=True)
+        elif entry.suffix == ".npy" and previous is not None:
+            entry.unlink()  # Columns of a bundle from before versioning
+
+
+def open_city_bundle(p: Path, placeid: str):
+    """Memory-map the bundle written by write_city_bundle.
+    Returns a dict with the manifest and the mapped columns, or None if the
+    city has no bundle at path p. Errors reading an existing bundle are raised.
+    """
+    bundle_dir = p / f"{placeid}_bundle"
+    for attempt in range(3):
+        try:
+            with open(bundle_dir / "manifest.json") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        columns_dir = bundle_dir / manifest.get("version", "")
+        try:
+            columns = {
+                key: np.load(columns_dir / f"{key}.npy", mmap_mode="r")
+                for key in BUNDLE_NODE_KEYS + BUNDLE_EDGE_KEYS + ["variant_nodes"]
+            }
+        except FileNotFoundError:
+            # Two newer bundles were written while this one was opened
+            if attempt == 2:
+                raise
+            continue
+        return {"manifest": manifest, "columns": columns}
 
-                osmid = int(line_list[header.index("osmid")])
-                values_x[osmid] = float(line_list[header.index("x")])
-                values_y[osmid] = float(line_list[header.index("y")])
 
-        # Set node attributes
-        nx.set_node_attributes(G, values_x, "x")
-        nx.set_node_attributes(G, values_y, "y")
+def bundle_arrays(bundle, variant: str):
+    """Return the columnar arrays of one variant of an opened city bundle,
+    or None if the bundle does not hold that variant.
+    """
+    slices = bundle["manifest"]["variants"].get(variant)
+    if slices is None:
+        return None
+    columns = bundle["columns"]
+    node_index = np.asarray(columns["variant_nodes"][slice(*slices["nodes"])])
+    arrays = {key: columns[key][node_index] for key in BUNDLE_NODE_KEYS}
+    for key in BUNDLE_EDGE_KEYS:
+        arrays[key] = np.array(columns[key][slice(*slices["edges"])])
+    return arrays
+
+
+def arrays_to_ig(arrays) -> ig.Graph:
+    """Turn columnar graph arrays into an igraph Graph, as csv_to_ig does.
+    Coordinates are rounded and y mirrored (see normalize_coordinates), using
+    the precomputed node_ig_x/node_ig_y arrays if present.
+    """
+    if len(arrays["node_osmid"]) == 0:
+        return ig.Graph(directed=False)
 
-    except FileNotFoundError:
-        print(f"Error: The file {nodes_file} does not exist.")
-        return None  # Or handle as appropriate
+    if "node_ig_x" in arrays:
+        x, y = arrays["node_ig_x"], arrays["node_ig_y"]
+    else:
+        x, y = normalize_coordinates(arrays["node_x"], arrays["node_y"])
+    node = pd.DataFrame({"osmid": arrays["node_osmid"], "x": x, "y": y})
+    edge = pd.DataFrame(
+        {
+            "u": arrays["edge_u"],
+            "v": arrays["edge_v"],
+            "length": arrays["edge_length"],
+            "osmid": arrays["edge_osmid"],
+        }
+    )
+    return osm_to_ig(node, edge)
 
-    # Clean up unzipped files if needed
-    if compress:
-        edges_file.unlink()  # Remove edges file
-        nodes_file.unlink()  # Remove nodes file
 
+def arrays_to_ox(arrays) -> nx.MultiDiGraph:
+    """Turn columnar graph arrays into a networkx MultiDiGraph, as csv_to_ox does.
+    As there, only nodes that are part of an edge are kept.
+    """
+    G = nx.MultiDiGraph()
+    G.add_edges_from(
+        (u, v, {"osmid": osmid, "length": length})
+        for u, v, osmid, length in zip(
+            arrays["edge_u"].tolist(),
+            arrays["edge_v"].tolist(),
+            arrays["edge_osmid"].tolist(),
+            arrays["edge_length"].tolist(),
+        )
+    )
+    values_x = dict(zip(arrays["node_osmid"].tolist(), arrays["node_x"].tolist()))
+    values_y = dict(zip(arrays["node_osmid"].tolist(), arrays["node_y"].tolist()))
+    nx.set_node_attributes(G, values_x, "x")
+    nx.set_node_attributes(G, values_y, "y")
     return G
 
 
-def csv_to_ig(
-    p: Path, placeid: str, parameterid: str, cleanup: bool = True
-) -> ig.Graph:
-    """Load an ig graph from _edges.csv and _nodes.csv
+@contextmanager
+def open_graph_csv(p: Path, prefix: str, table: str):
+    """Open prefix+'_'+table+'.csv' (table is 'nodes' or 'edges') for reading.
+    The CSV is streamed straight from its compressed version (.csv.zst,
+    .csv.lz4 or .zip, the newest if there are several) if available, so
+    nothing is extracted to p and concurrent loads of the same city do not
+    interfere with each other. Otherwise the plain CSV at path p is opened.
+    Yields a text stream; raises FileNotFoundError if no file exists.
+    """
+    member = f"{prefix}_{table}.csv"
+    zst_file = p / f"{member}.zst"
+    lz4_file = p / f"{member}.lz4"
+    zip_file = p / f"{prefix}_{table}.zip"
+    mtimes = {}
+    for file in (zst_file, lz4_file, zip_file):
+        try:
+            mtimes[file] = file.stat().st_mtime_ns
+        except FileNotFoundError:
+            pass
+    newest = max(mtimes, key=mtimes.get) if mtimes else None
+    if newest == zst_file:
+        import zstandard
+
+        with zst_file.open("rb") as fh:
+            with zstandard.ZstdDecompressor().stream_reader(fh) as f:
+                yield io.TextIOWrapper(f, encoding="utf-8", newline="")
+    elif newest == lz4_file:
+        import lz4.frame
+
+        with lz4.frame.open(lz4_file, "rb") as f:
+            yield io.TextIOWrapper(f, encoding="utf-8", newline="")
+    elif newest == zip_file:
+        with zipfile.ZipFile(zip_file, "r") as zfile:
+            with zfile.open(member, "r") as f:
+                yield io.TextIOWrapper(f, encoding="utf-8", newline="")
+    else:
+        with (p / member).open("r", encoding="utf-8", newline="") as f:
+            yield f
+
+
+def _first_of_list_column(column: pd.Series) -> pd.Series:
+    """Vectorized version of taking eval(value)[0] on list-valued CSV cells
+    such as "[123, 456]". Cells that cannot be parsed become NaN.
+    """
+    if pd.api.types.is_numeric_dtype(column):
+        return column
+    first = (
+        column.astype(str)
+        .str.strip()
+        .str.lstrip("[")
+        .str.split(",", n=1)
+        .str[0]
+        .str.strip()
+    )
+    return pd.to_numeric(first, errors="coerce")
+
+
+def read_graph_csv(p: Path, prefix: str):
+    """Read prefix+'_nodes.csv' and prefix+'_edges.csv' (or their zips) into
+    the same columnar arrays as read_graph_npz. List-valued osmid and length
+    cells keep their first element; edges that cannot be parsed are skipped.
+    Returns None if the files do not exist.
+    """
+    try:
+        with open_graph_csv(p, prefix, "nodes") as f:
+            node = pd.read_csv(f, float_precision="round_trip")
+        with open_graph_csv(p, prefix, "edges") as f:
+            edge = pd.read_csv(f, float_precision="round_trip")
+    except FileNotFoundError:
+        return None
+
+    if not {"osmid", "x", "y"} <= set(node.columns):
+        node = pd.DataFrame(columns=["osmid", "x", "y"])
+    if not {"u", "v", "osmid", "length"} <= set(edge.columns):
+        edge = pd.DataFrame(columns=["u", "v", "osmid", "length"])
+
+    edge_osmid = _first_of_list_column(edge["osmid"])
+    edge_length = _first_of_list_column(edge["length"])
+    valid = (edge_osmid.notna() & edge_length.notna()).to_numpy()
+
+    return {
+        "node_osmid": node["osmid"].to_numpy(dtype=np.int64),
+        "node_x": node["x"].to_numpy(dtype=np.float64),
+        "node_y": node["y"].to_numpy(dtype=np.float64),
+        "edge_u": edge["u"].to_numpy(dtype=np.int64)[valid],
+        "edge_v": edge["v"].to_numpy(dtype=np.int64)[valid],
+        "edge_length": edge_length.to_numpy(dtype=np.float64)[valid],
+        "edge_osmid": edge_osmid.to_numpy(dtype=np.float64)[valid].astype(np.int64),
+    }
+
+
+def graph_source_version(p: Path, placeid: str, parameterid: str):
+    """Return a version tag of the files a graph is loaded from,
+    as (name, mtime, size) of each existing file, or None if there are none.
+    """
+    prefix = f"{placeid}_{parameterid}"
+    version = []
+    for name in [
+        f"{placeid}_bundle/manifest.json",
+        f"{prefix}_graph.npz",
+        f"{prefix}_nodes.csv.zst",
+        f"{prefix}_edges.csv.zst",
+        f"{prefix}_nodes.csv.lz4",
+        f"{prefix}_edges.csv.lz4",
+        f"{prefix}_nodes.zip",
+        f"{prefix}_edges.zip",
+        f"{prefix}_nodes.csv",
+        f"{prefix}_edges.csv",
+    ]:
+        try:
+            stat = (p / name).stat()
+        except FileNotFoundError:
+            continue
+        version.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(version) or None
+
+
+class GraphCache:
+    """Process-wide LRU cache of graphs loaded by csv_to_ig and csv_to_ox.
+    Entries are keyed by (folder, prefix, graph kind, source file version),
+    so refreshed files are reloaded. Callers get a copy of the cached graph
+    and may mutate it freely. Evicts least recently used graphs when the
+    estimated size exceeds max_bytes. Graphs of files that were refreshed
+    are dropped when the new version is cached, counted as stale.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    @staticmethod
+    def estimate_nbytes(G):
+        """Rough memory footprint of a graph and its Python attribute objects."""
+        if isinstance(G, ig.Graph):
+            return 250 * G.vcount() + 200 * G.ecount()
+        return 700 * G.number_of_nodes() + 900 * G.number_of_edges()
+
+    def get(self, key, load):
+        """Return a copy of the graph cached under key, loading it with load() on a miss."""
+        with self._lock:
+            G = self._graphs.get(key)
+            if G is not None:
+                self._graphs.move_to_end(key)
+                self.hits += 1
+                return G.copy()
+            self.misses += 1
+
+        G = load()
+        nbytes = self.estimate_nbytes(G)
+        if nbytes > self.max_bytes:
+            return G
+
+        with self._lock:
+            # Graphs loaded from an older version of the same files are stale
+            for stale in [k for k in self._graphs if k[:-1] == key[:-1] and k != key]:
+                self.nbytes -= self.estimate_nbytes(self._graphs.pop(stale))
+                self.stale += 1
+            if key not in self._graphs:
+                self._graphs[key] = G
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._graphs.popitem(last=False)
+                self.nbytes -= self.estimate_nbytes(evicted)
+                self.evictions += 1
+        return G.copy()
+
+    def clear(self):
+        with self._lock:
+            self._graphs.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._graphs),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "stale": self.stale,
+            }
+
+
+graph_cache = GraphCache(graph_cache_mb * 2**20)
+
+
+class ResultCache:
+    """Persistent cache of model results on disk, keyed by a hash of the inputs
+    they depend on. Each entry is a folder holding copies of the result files
+    and the database segment rows, so it is shared by processes and restarts.
+    Entries older than max_age seconds are dropped, and the least recently used
+    ones while the cache exceeds max_bytes.
+    """
+
+    segments_name = "segments.pickle"
+
+    def __init__(self, root, max_bytes, max_age):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(**inputs):
+        """Hash of the JSON encoding of the keyword arguments."""
+        encoded = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def _entries(self):
+        """(path, last use, created, size in bytes) of the complete entries."""
+        entries = []
+        try:
+            folders = list(self.root.iterdir())
+        except OSError:
+            return entries
+        for entry in folders:
+            if entry.name.startswith("."):  # Being written by put
+                continue
+            try:
+                if not entry.is_dir():
+                    continue
+                created = (entry / self.segments_name).stat().st_mtime
+                used = entry.stat().st_mtime
+                nbytes = sum(f.stat().st_size for f in entry.iterdir())
+            except OSError:  # Evicted or replaced meanwhile
+                continue
+            entries.append((entry, used, created, nbytes))
+        return entries
+
+    def get(self, key):
+        """Return (folder with the result files, segment rows) cached under key,
+        or None on a miss. A hit marks the entry as recently used.
+        """
+        entry = self.root / key
+        segments_path = entry / self.segments_name
+        try:
+            age = time.time() - segments_path.stat().st_mtime
+            if self.max_bytes <= 0 or age > self.max_age:
+                raise FileNotFoundError
+            with segments_path.open("rb") as f:
+                segments = pickle.load(f)
+            os.utime(entry)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry, segments
+
+    def put(self, key, files, segments):
+        """Store copies of files and the segment rows under key, then evict."""
+        if self.max_bytes <= 0:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging = self.root / f".{key}.{os.getpid()}.{threading.get_ident()}"
+        staging.mkdir()
+        try:
+            for file in files:
+                shutil.copyfile(file, staging / Path(file).name)
+            # Written last: it marks the entry as complete
+            with (staging / self.segments_name).open("wb") as f:
+                pickle.dump(segments, f)
+            shutil.rmtree(self.root / key, ignore_errors=True)
+            os.replace(staging, self.root / key)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Drop the expired entries, then the least recently used over max_bytes."""
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        nbytes = sum(entry[3] for entry in entries)
+        for entry, used, created, size in entries:
+            if now - created <= self.max_age and nbytes <= self.max_bytes:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            nbytes -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                "entries": len(entries),
+                "nbytes": sum(entry[3] for entry in entries),
+                "max_bytes": self.max_bytes,
+                "max_age": self.max_age,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+result_cache = ResultCache(
+    PATH["result_cache"], result_cache_mb * 2**20, result_cache_max_age_days * 86400
+)
+
+
+class GraphNotFoundError(FileNotFoundError):
+    """Raised by load_graph_arrays if no file holds the graph."""
+
+
+def load_graph_arrays(p: Path, placeid: str, parameterid: str, bundle=None):
+    """Load the columnar arrays of a graph, from the city bundle if it holds the
+    graph, else from <prefix>_graph.npz if it exists, otherwise from the
+    CSV/zip files. An already opened bundle can be passed to skip opening it.
+    Raises GraphNotFoundError if none of them exists; errors reading files
+    that exist are raised as they are.
+    """
+    prefix = f"{placeid}_{parameterid}"
+    if bundle is None:
+        bundle = open_city_bundle(p, placeid)
+    arrays = bundle_arrays(bundle, parameterid) if bundle is not None else None
+    if arrays is None:
+        arrays = read_graph_npz(p, prefix)
+    if arrays is None:
+        arrays = read_graph_csv(p, prefix)
+    if arrays is None:
+        raise GraphNotFoundError(f"No graph files for {prefix} at {p}")
+    return arrays
+
+
+def csv_to_ox(p: Path, placeid: str, parameterid: str) -> nx.MultiDiGraph:
+    """Load a networkx graph from _edges.csv and _nodes.csv
     The edge file must have attributes u,v,osmid,length
     The node file must have attributes y,x,osmid
     Only these attributes are loaded.
+    If the city bundle or a <prefix>_graph.npz holds the graph, it is used instead.
+    Graphs are served from graph_cache while their files are unchanged.
     """
     prefix = f"{placeid}_{parameterid}"
-    compress = check_extract_zip(p, prefix)
-    empty = False
+    try:
+        return graph_cache.get(
+            (str(p), prefix, "ox", graph_source_version(p, placeid, parameterid)),
+            lambda: arrays_to_ox(load_graph_arrays(p, placeid, parameterid)),
+        )
+    except GraphNotFoundError:
+        print(f"Error: The files for {prefix} do not exist.")
+        return None  # Or handle as appropriate
 
-    # Define paths for the nodes and edges CSV files
-    nodes_file = p / f"{prefix}_nodes.csv"
-    edges_file = p / f"{prefix}_edges.csv"
 
+def csv_to_ig(p: Path, placeid: str, parameterid: str) -> ig.Graph:
+    """Load an ig graph from _edges.csv and _nodes.csv
+    The edge file must have attributes u,v,osmid,length
+    The node file must have attributes y,x,osmid
+    Only these attributes are loaded.
+    If the city bundle or a <prefix>_graph.npz holds the graph, it is used instead.
+    Graphs are served from graph_cache while their files are unchanged.
+    Returns an empty graph if there are no files for it.
+    """
+    prefix = f"{placeid}_{parameterid}"
     try:
-        n = pd.read_csv(nodes_file)
-        e = pd.read_csv(edges_file)
-    except FileNotFoundError:
-        empty = True
+        return graph_cache.get(
+            (str(p), prefix, "ig", graph_source_version(p, placeid, parameterid)),
+            lambda: arrays_to_ig(load_graph_arrays(p, placeid, parameterid)),
+        )
+    except GraphNotFoundError:
+        return ig.Graph(directed=False)
 
-    if (
-        compress and cleanup and not SERVER
-    ):  # do not clean up on the server as csv is needed in parallel jobs
-        nodes_file.unlink(missing_ok=True)  # Remove nodes file if it exists
-        edges_file.unlink(missing_ok=True)  # Remove edges file if it exists
 
-    if empty:
-        return ig.Graph(directed=False)
+def load_city_bundle(p: Path, placeid: str, variants=None) -> dict:
+    """Load several network variants of a city (default: all variants in its
+    bundle) as igraph graphs, returned as a dict variant -> graph.
+    The bundle is opened and memory-mapped once for all of them; variants
+    that are not in the bundle are loaded as csv_to_ig does. Errors reading
+    files that exist are raised rather than giving an empty graph.
+    """
+    bundle = open_city_bundle(p, placeid)
+    if variants is None:
+        variants = list(bundle["manifest"]["variants"]) if bundle is not None else []
 
-    G = osm_to_ig(n, e)
-    round_coordinates(G)
-    mirror_y(G)
-    return G
+    Gs = {}
+    for variant in variants:
+        try:
+            Gs[variant] = graph_cache.get(
+                (
+                    str(p),
+                    f"{placeid}_{variant}",
+                    "ig",
+                    graph_source_version(p, placeid, variant),
+                ),
+                lambda: arrays_to_ig(load_graph_arrays(p, placeid, variant, bundle)),
+            )
+        except GraphNotFoundError:
+            Gs[variant] = ig.Graph(directed=False)
+    return Gs
 
 
 def ig_to_geojson(G):
@@ -630,6 +1222,48 @@ def ig_to_geojson(G):
     return G_geojson
 
 
+def new_edge_wkts(Gs, precision=6):
+    """For each graph of Gs, nested subgraphs like the GTs of increasing
+    quantiles, the WKT LineStrings of the edges joining end nodes (by id) not
+    joined in the previous graph, in edge order. The lines run from source
+    (x, -y) to target (x, -y) as in ig_to_geojson, rounded to precision
+    decimals like geojson does.
+    """
+    ids = [
+        np.asarray(G.vs["id"]) if G.vcount() else np.empty(0, dtype=np.int64)
+        for G in Gs
+    ]
+    all_ids = np.unique(np.concatenate(ids)) if ids else np.empty(0)
+    previous = np.empty(0, dtype=np.int64)
+    wkts = []
+    for G, G_ids in zip(Gs, ids):
+        if not G.ecount():
+            previous = np.empty(0, dtype=np.int64)
+            wkts.append([])
+            continue
+        source, target = np.asarray(G.get_edgelist(), dtype=np.int64).T
+        a = np.searchsorted(all_ids, G_ids[source])
+        b = np.searchsorted(all_ids, G_ids[target])
+        keys = np.minimum(a, b) * len(all_ids) + np.maximum(a, b)
+        _, first = np.unique(keys, return_index=True)
+        first.sort()  # One edge per pair of end nodes, in edge order
+        new = first[~np.isin(keys[first], previous)]
+        previous = keys
+        x = round_array(G.vs["x"], precision)
+        y = round_array(-np.asarray(G.vs["y"], dtype=np.float64), precision)
+        lines = shapely.linestrings(
+            np.stack(
+                (
+                    np.column_stack((x[source[new]], y[source[new]])),
+                    np.column_stack((x[target[new]], y[target[new]])),
+                ),
+                axis=1,
+            )
+        )
+        wkts.append(shapely.to_wkt(lines, rounding_precision=-1).tolist())
+    return wkts
+
+
 # NETWORK GENERATION
 
 
@@ -701,21 +1335,363 @@ def segments_intersect(A, B, C, D):
         or (B.x == D.x and B.y == D.y)
     ):
         return False  # If the segments share an endpoint they do not intersect properly
+    if (
+        max(A.x, B.x) < min(C.x, D.x)
+        or max(C.x, D.x) < min(A.x, B.x)
+        or max(A.y, B.y) < min(C.y, D.y)
+        or max(C.y, D.y) < min(A.y, B.y)
+    ):
+        return False  # Disjoint bounding boxes; ccw could err for near colinearity
     return ccw(A, C, D) != ccw(B, C, D) and ccw(A, B, C) != ccw(A, B, D)
 
 
+def segments_intersect_array(ax, ay, bx, by, cx, cy, dx, dy):
+    """Elementwise segments_intersect of segments AB and CD given as arrays
+    of their coordinates (scalars broadcast). Uses the same arithmetic as ccw,
+    so the results are identical.
+    """
+    shared = (
+        ((ax == cx) & (ay == cy))
+        | ((ax == dx) & (ay == dy))
+        | ((bx == cx) & (by == cy))
+        | ((bx == dx) & (by == dy))
+    )
+    acd = (dy - ay) * (cx - ax) > (cy - ay) * (dx - ax)
+    bcd = (dy - by) * (cx - bx) > (cy - by) * (dx - bx)
+    abc = (cy - ay) * (bx - ax) > (by - ay) * (cx - ax)
+    abd = (dy - ay) * (bx - ax) > (by - ay) * (dx - ax)
+    overlap = (
+        (np.minimum(ax, bx) <= np.maximum(cx, dx))
+        & (np.minimum(cx, dx) <= np.maximum(ax, bx))
+        & (np.minimum(ay, by) <= np.maximum(cy, dy))
+        & (np.minimum(cy, dy) <= np.maximum(ay, by))
+    )
+    return (acd != bcd) & (abc != abd) & ~shared & overlap
+
+
+class SegmentIndex:
+    """Incremental spatial index of line segments (rows Ax, Ay, Bx, By) for
+    batched crossing checks. A query segment is only tested with
+    segments_intersect_array against the segments whose bounding boxes
+    overlap its own, widened by margin against rounding errors.
+    The bounding boxes are kept in a shapely STRtree. As an STRtree cannot
+    grow, segments added since it was built are scanned directly, and the tree
+    is rebuilt once there are more than rebuild_size of them or a quarter of
+    the indexed ones.
+    """
+
+    def __init__(self, segments=None, margin=1e-9, rebuild_size=256):
+        self.margin = margin
+        self.rebuild_size = rebuild_size
+        self.segments = np.empty((0, 4), dtype=np.float64)
+        self.boxes = np.empty((0, 4), dtype=np.float64)
+        self.tree = None
+        self.tree_size = 0  # The first tree_size segments are in the tree
+        if segments is not None:
+            self.add(segments)
+
+    @staticmethod
+    def bounding_boxes(segments):
+        """Rows (min x, max x, min y, max y) of the segments."""
+        return np.column_stack(
+            (
+                np.minimum(segments[:, 0], segments[:, 2]),
+                np.maximum(segments[:, 0], segments[:, 2]),
+                np.minimum(segments[:, 1], segments[:, 3]),
+                np.maximum(segments[:, 1], segments[:, 3]),
+            )
+        )
+
+    def add(self, segments):
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        self.segments = np.concatenate([self.segments, segments])
+        self.boxes = np.concatenate([self.boxes, self.bounding_boxes(segments)])
+        untreed = len(self.segments) - self.tree_size
+        if untreed > max(self.rebuild_size, self.tree_size // 4):
+            box = self.boxes
+            self.tree = shapely.STRtree(
+                shapely.box(box[:, 0], box[:, 2], box[:, 1], box[:, 3])
+            )
+            self.tree_size = len(self.segments)
+
+    def crossings(self, queries, count=None):
+        """Return the arrays (query row, indexed row) of all pairs of a query
+        segment and one of the first count indexed segments (all by default)
+        that intersect properly.
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 4)
+        count = len(self.segments) if count is None else min(count, len(self.segments))
+        if not count or not len(queries):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        qbox, m = self.bounding_boxes(queries), self.margin
+        q, s = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        if self.tree is not None:
+            q, s = self.tree.query(
+                shapely.box(
+                    qbox[:, 0] - m, qbox[:, 2] - m, qbox[:, 1] + m, qbox[:, 3] + m
+                )
+            )
+            q, s = q[s < count], s[s < count]
+        # Segments not in the tree yet
+        sbox = self.boxes[self.tree_size : count]
+        q_rest, s_rest = np.nonzero(
+            (sbox[:, 0] <= qbox[:, 1:2] + m)
+            & (sbox[:, 1] >= qbox[:, 0:1] - m)
+            & (sbox[:, 2] <= qbox[:, 3:4] + m)
+            & (sbox[:, 3] >= qbox[:, 2:3] - m)
+        )
+        q = np.concatenate((q, q_rest))
+        s = np.concatenate((s, s_rest + self.tree_size))
+        hit = segments_intersect_array(*queries[q].T, *self.segments[s].T)
+        return q[hit], s[hit]
+
+    def crossed(self, queries) -> np.ndarray:
+        """Return for each query segment whether it intersects any indexed
+        segment properly (see segments_intersect).
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 4)
+        result = np.zeros(len(queries), dtype=bool)
+        result[self.crossings(queries)[0]] = True
+        return result
+
+
 def new_edge_intersects(G, enew):
     """Given a graph G and a potential new edge enew,
     check if enew will intersect any old edge.
     """
-    E1 = MyPoint(enew[0], enew[1])
-    E2 = MyPoint(enew[2], enew[3])
-    for e in G.es():
-        O1 = MyPoint(e.source_vertex["x"], e.source_vertex["y"])
-        O2 = MyPoint(e.target_vertex["x"], e.target_vertex["y"])
-        if segments_intersect(E1, E2, O1, O2):
-            return True
-    return False
+    if not G.ecount():
+        return False
+    x, y = np.asarray(G.vs["x"]), np.asarray(G.vs["y"])
+    source, target = np.asarray(G.get_edgelist()).T
+    return bool(
+        np.any(
+            segments_intersect_array(*enew, x[source], y[source], x[target], y[target])
+        )
+    )
+
+
+def candidate_poipairs(x, y, first, second, mode="delaunay", k=10) -> np.ndarray:
+    """Mask of the poipairs (vertex indices first, second in ascending order
+    of distance) that are likely greedy triangulation edges. mode is
+    delaunay (Delaunay neighbours of the coordinates x, y), knn (among the k
+    shortest pairs of either vertex) or delaunay+knn (both). On network
+    distances none of them is sure to hold every GT edge.
+    """
+    keep = np.zeros(len(first), dtype=bool)
+    if "delaunay" in mode:
+        from scipy.spatial import Delaunay, QhullError
+
+        try:
+            simplices = Delaunay(np.column_stack((x, y))).simplices
+        except (QhullError, ValueError):  # Too few or colinear points
+            return np.ones(len(first), dtype=bool)
+        a = simplices[:, [0, 1, 2]].ravel()
+        b = simplices[:, [1, 2, 0]].ravel()
+        codes = np.minimum(a, b) * len(x) + np.maximum(a, b)
+        keep |= np.isin(
+            np.minimum(first, second) * len(x) + np.maximum(first, second), codes
+        )
+    if "knn" in mode:
+        ends = np.concatenate((first, second))
+        positions = np.tile(np.arange(len(first)), 2)
+        order = np.lexsort((positions, ends))
+        ends, positions = ends[order], positions[order]
+        group_start = np.flatnonzero(np.r_[True, ends[1:] != ends[:-1]])
+        rank = np.arange(len(ends)) - np.repeat(
+            group_start, np.diff(np.r_[group_start, len(ends)])
+        )
+        keep[positions[rank < k]] = True
+    return keep
+
+
+def _greedy_triangulation_accept(
+    index, candidates, first, second, positions, batch_size
+):
+    """Return the positions (ascending) of the candidates the greedy
+    triangulation keeps when only the given positions are considered. The
+    accepted segments are added to index.
+    Pairs are checked in batches against index, then one by one against the
+    edges added within the batch.
+    """
+    accepted = []
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start : start + batch_size]
+        crossed = index.crossed(candidates[batch])
+        added = []  # Segments added in this batch, as igraph orients them
+        for k in batch[~crossed]:
+            if added and np.any(
+                segments_intersect_array(*candidates[k], *np.array(added).T)
+            ):
+                continue
+            accepted.append(k)
+            # igraph stores undirected edges as (smaller, larger) vertex index
+            if first[k] < second[k]:
+                added.append(candidates[k])
+            else:
+                added.append(candidates[k][[2, 3, 0, 1]])
+        if added:
+            index.add(added)
+    return np.array(accepted, dtype=np.int64)
+
+
+def _unblocked_poipairs(index, existing, accepted, segments, left_out, batch_size):
+    """Return the left out positions, in the first batch that has any, whose
+    segment crosses none of the edges accepted before them. The rows of index
+    are the existing edges followed by the accepted ones in order.
+    """
+    order = np.concatenate((np.full(existing, -1), accepted))
+    for start in range(0, len(left_out), batch_size):
+        batch = left_out[start : start + batch_size]
+        q, s = index.crossings(
+            segments[batch], existing + np.searchsorted(accepted, batch[-1])
+        )
+        blocked = np.zeros(len(batch), dtype=bool)
+        blocked[q[order[s] < batch[q]]] = True
+        if not blocked.all():
+            return batch[~blocked]
+    return left_out[:0]
+
+
+def add_greedy_triangulation_edges(
+    GT,
+    poipairs,
+    candidates=gt_candidates,
+    k=gt_candidates_k,
+    verify=gt_candidates_verify,
+    batch_size=256,
+):
+    """Add inplace to GT the edges of the greedy triangulation of poipairs:
+    pairs are connected in the given order unless the new edge would cross
+    an existing one.
+    If candidates is not all, only the pairs selected by candidate_poipairs
+    are triangulated. Every left out pair must then cross an edge accepted
+    before it; those that do not are added to the candidates and the
+    triangulation is resumed from the first of them, so the result equals
+    the exhaustive one. This check costs about as much as the exhaustive
+    triangulation, so pruning is only faster without verify, when the result
+    is approximate: long edges may be missed.
+    """
+    if not poipairs:
+        return
+    x, y = np.asarray(GT.vs["x"]), np.asarray(GT.vs["y"])
+    source, target = np.asarray(GT.get_edgelist(), dtype=np.int64).reshape(-1, 2).T
+    existing = np.column_stack((x[source], y[source], x[target], y[target]))
+    first = np.array(vertex_indices(GT, [poipair[0] for poipair, _ in poipairs]))
+    second = np.array(vertex_indices(GT, [poipair[1] for poipair, _ in poipairs]))
+    segments = np.column_stack((x[first], y[first], x[second], y[second]))
+
+    if candidates == "all":
+        keep = np.ones(len(poipairs), dtype=bool)
+    else:
+        keep = candidate_poipairs(x, y, first, second, candidates, k)
+    index = SegmentIndex(existing)
+    accepted = np.empty(0, dtype=np.int64)
+    start = 0  # Decisions on the pairs before start are final
+    while True:
+        accepted = np.concatenate(
+            (
+                accepted,
+                _greedy_triangulation_accept(
+                    index,
+                    segments,
+                    first,
+                    second,
+                    np.flatnonzero(keep[start:]) + start,
+                    batch_size,
+                ),
+            )
+        )
+        if not verify:
+            break
+        unblocked = _unblocked_poipairs(
+            index,
+            len(existing),
+            accepted,
+            segments,
+            np.flatnonzero(~keep[start:]) + start,
+            batch_size,
+        )
+        if not len(unblocked):
+            break
+        keep[unblocked] = True
+        start = unblocked[0]
+        accepted = accepted[: np.searchsorted(accepted, start)]
+        index = SegmentIndex(index.segments[: len(existing) + len(accepted)])
+
+    GT.add_edges(
+        [(int(first[i]), int(second[i])) for i in accepted],
+        attributes={"weight": [poipairs[i][1] for i in accepted]},
+    )
+
+
+_vertex_id_maps = {}
+
+
+def _forget_vertex_id_map(key):
+    def forget(ref):
+        entry = _vertex_id_maps.get(key)
+        if entry is not None and entry[0] is ref:
+            del _vertex_id_maps[key]
+
+    return forget
+
+
+def forget_vertex_id_map(G):
+    """Drop the vertex_id_map of G. Functions that add or delete vertices of
+    G, or change their ids, in place must call it.
+    """
+    entry = _vertex_id_maps.get(id(G))
+    if entry is not None and entry[0]() is G:
+        del _vertex_id_maps[id(G)]
+
+
+def vertex_id_map(G, rebuild=False) -> dict:
+    """Return a dict vertex id -> vertex index of G (the first vertex for
+    repeated ids). The map is built once per graph object and kept until the
+    graph is garbage collected or forget_vertex_id_map(G) is called; it is
+    rebuilt when the vertex count changed or if rebuild. Copies and subgraphs
+    of G get their own map on first use.
+    """
+    key = id(G)
+    entry = _vertex_id_maps.get(key)
+    if not rebuild and entry is not None and entry[0]() is G and entry[1] == G.vcount():
+        return entry[2]
+    ids = G.vs["id"] if "id" in G.vs.attributes() else []
+    id_map = dict(zip(reversed(ids), range(len(ids) - 1, -1, -1)))
+    _vertex_id_maps[key] = (
+        weakref.ref(G, _forget_vertex_id_map(key)),
+        G.vcount(),
+        id_map,
+    )
+    return id_map
+
+
+def vertex_index(G, vertex_id) -> int:
+    """Index of the vertex of G whose id is vertex_id, as
+    G.vs.find(id=vertex_id).index but without scanning all vertices.
+    Raises ValueError if there is no such vertex. The map is dropped by the
+    functions that edit the vertices of G in place (see forget_vertex_id_map)
+    and rebuilt if the vertex it points to has another id.
+    """
+    index = vertex_id_map(G).get(vertex_id)
+    if index is None:
+        raise ValueError(f"no such vertex: {vertex_id}")
+    if G.vs[index]["id"] != vertex_id:
+        # The ids have changed since the map was built
+        index = vertex_id_map(G, rebuild=True).get(vertex_id)
+        if index is None:
+            raise ValueError(f"no such vertex: {vertex_id}")
+    return index
+
+
+def vertex_indices(G, vertex_ids) -> list:
+    """Indices of the vertices of G whose ids are vertex_ids, see vertex_index."""
+    vertex_ids = list(vertex_ids)
+    id_map = vertex_id_map(G)
+    indices = [id_map.get(vertex_id) for vertex_id in vertex_ids]
+    if None in indices or (indices and G.vs.select(indices)["id"] != vertex_ids):
+        return [vertex_index(G, vertex_id) for vertex_id in vertex_ids]
+    return indices
 
 
 def delete_overlaps(G_res, G_orig, verbose=False):
@@ -728,16 +1704,17 @@ def delete_overlaps(G_res, G_orig, verbose=False):
             n1_id = e.source_vertex["id"]
             n2_id = e.target_vertex["id"]
             # If there is already an edge in the original network, delete it
-            n1_index = G_orig.vs.find(id=n1_id).index
-            n2_index = G_orig.vs.find(id=n2_id).index
+            n1_index = vertex_index(G_orig, n1_id)
+            n2_index = vertex_index(G_orig, n2_id)
             if G_orig.are_connected(n1_index, n2_index):
                 del_edges.append(e.index)
-        except:
+        except (KeyError, ValueError):  # No ids, or an end node is not in G_orig
             pass
     G_res.delete_edges(del_edges)
     # Remove isolated nodes
     isolated_nodes = G_res.vs.select(_degree_eq=0)
     G_res.delete_vertices(isolated_nodes)
+    forget_vertex_id_map(G_res)
     if verbose:
         print(
             "Removed "
@@ -754,11 +1731,11 @@ def constrict_overlaps(G_res, G_orig, factor=5):
         try:
             n1_id = e.source_vertex["id"]
             n2_id = e.target_vertex["id"]
-            n1_index = G_orig.vs.find(id=n1_id).index
-            n2_index = G_orig.vs.find(id=n2_id).index
+            n1_index = vertex_index(G_orig, n1_id)
+            n2_index = vertex_index(G_orig, n2_id)
             if G_orig.are_connected(n1_index, n2_index):
                 G_res.es[e.index]["weight"] = factor * G_res.es[e.index]["weight"]
-        except:
+        except (KeyError, ValueError):  # No ids, or an end node is not in G_orig
             pass
 
 
@@ -794,10 +1771,6 @@ def greedy_triangulation_routing_clusters(
             clusterinfo.items(), key=lambda item: item[1]["size"], reverse=True
         )
     ]
-    G_temp = copy.deepcopy(G_total)
-    for e in G_temp.es:  # delete all edges
-        G_temp.es.delete(e)
-
     clusterpairs = clusterpairs_by_distance(
         G, G_total, clusters, clusterinfo, True, verbose, full_run
     )
@@ -812,68 +1785,156 @@ def greedy_triangulation_routing_clusters(
         for c in clusterpairs
     ]
 
-    GT_abstracts = []
+    centroidids_closestnodeids = (
+        {}
+    )  # dict for retrieveing quickly closest node ids pairs from centroidid pairs
+    for x in clusterpairs:
+        centroidids_closestnodeids[
+            (
+                clusterinfo[x[0][0]]["centroid_id"],
+                clusterinfo[x[0][1]]["centroid_id"],
+            )
+        ] = (x[1][0], x[1][1])
+        centroidids_closestnodeids[
+            (
+                clusterinfo[x[0][1]]["centroid_id"],
+                clusterinfo[x[0][0]]["centroid_id"],
+            )
+        ] = (
+            x[1][1],
+            x[1][0],
+        )  # also add switched version as we do not care about order
+
+    # Triangulate once, all quantiles are prunings of the same GT
+    GT_abstracts = greedy_triangulation_quantiles(
+        edgeless_subgraph(G_total, centroid_indices),
+        centroidpairs,
+        prune_quantiles,
+        prune_measure,
+    )
+
+    # Do the routing, on G_total, every node pair is routed once for all quantiles
+    path_cache = PathCache(G_total)
     GTs = []
-    for prune_quantile in prune_quantiles:
-        GT_abstract = copy.deepcopy(G_temp.subgraph(centroid_indices))
-        GT_abstract = greedy_triangulation(
-            GT_abstract, centroidpairs, prune_quantile, prune_measure
+    for GT_abstract in GT_abstracts:
+        # get the closestnode-ids from centroid-ids
+        routenodepairs = [
+            centroidids_closestnodeids[(e.source_vertex["id"], e.target_vertex["id"])]
+            for e in GT_abstract.es
+        ]
+        GT_indices = path_cache.vertex_mask(
+            (vertex_index(G_total, poipair[0]), vertex_index(G_total, poipair[1]))
+            for poipair in routenodepairs
         )
-        GT_abstracts.append(GT_abstract)
+        GT = G_total.induced_subgraph(np.flatnonzero(GT_indices).tolist())
+        GTs.append(GT)
 
-        centroidids_closestnodeids = (
-            {}
-        )  # dict for retrieveing quickly closest node ids pairs from centroidid pairs
-        for x in clusterpairs:
-            centroidids_closestnodeids[
-                (
-                    clusterinfo[x[0][0]]["centroid_id"],
-                    clusterinfo[x[0][1]]["centroid_id"],
-                )
-            ] = (x[1][0], x[1][1])
-            centroidids_closestnodeids[
-                (
-                    clusterinfo[x[0][1]]["centroid_id"],
-                    clusterinfo[x[0][0]]["centroid_id"],
-                )
-            ] = (
-                x[1][1],
-                x[1][0],
-            )  # also add switched version as we do not care about order
-
-        # Get node pairs we need to route, sorted by distance
-        routenodepairs = []
-        for e in GT_abstract.es:
-            # get the centroid-ids from closestnode-ids
-            routenodepairs.append(
-                [
-                    centroidids_closestnodeids[
-                        (e.source_vertex["id"], e.target_vertex["id"])
-                    ],
-                    e["weight"],
-                ]
-            )
+    return (GTs, GT_abstracts)
 
-        routenodepairs.sort(key=lambda x: x[1])
 
-        # Do the routing, on G_total
-        GT_indices = set()
-        for poipair, poipair_distance in routenodepairs:
-            poipair_ind = (
-                G_total.vs.find(id=poipair[0]).index,
-                G_total.vs.find(id=poipair[1]).index,
-            )
-            sp = set(
-                G_total.get_shortest_paths(
-                    poipair_ind[0], poipair_ind[1], weights="weight", output="vpath"
-                )[0]
-            )
-            GT_indices = GT_indices.union(sp)
+def _path_distances(G, sources, targets):
+    """Distances on G from sources (rows) to targets (columns) as the sums of
+    the edge weights of get_shortest_paths, np.inf where that path is empty
+    (no path, or source equal to target).
+    """
+    unique, inverse = np.unique(
+        np.asarray(targets, dtype=np.int64), return_inverse=True
+    )
+    dist = distance_matrix(G, sources, unique.tolist())[:, inverse]
+    dist[np.asarray(sources)[:, None] == unique[inverse][None, :]] = np.inf
+    return dist
 
-        GT = G_total.induced_subgraph(GT_indices)
-        GTs.append(GT)
 
-    return (GTs, GT_abstracts)
+def closest_cluster_nodes(G, c1_indices, others, members, max_cells=2**24):
+    """Closest pair of nodes between the cluster with vertex indices
+    c1_indices and each cluster c2 in others (vertex indices members[c2]),
+    comparing all pairs. Returns a dict c2 -> (c1 index, c2 index, distance)
+    for the clusters that can be reached.
+    As in the node by node search it replaces, the first closest pair (by c1
+    then c2 index) wins and the search for c2 stops at the first c1 node
+    with no path to c2. Sources are routed in chunks of at most max_cells
+    distances to all of others at once.
+    """
+    targets = (
+        np.concatenate([members[c2] for c2 in others])
+        if others
+        else np.empty(0, dtype=np.int64)
+    )
+    bounds = np.cumsum([0] + [len(members[c2]) for c2 in others])
+    best = {}
+    searching = set(range(len(others)))
+    chunk = max(1, max_cells // max(1, len(targets)))
+    for start in range(0, len(c1_indices), chunk):
+        if not searching:
+            break
+        sources = c1_indices[start : start + chunk]
+        dist = _path_distances(G, sources.tolist(), targets.tolist())
+        for k in sorted(searching):
+            block = dist[:, bounds[k] : bounds[k + 1]]
+            empty = np.flatnonzero(~np.isfinite(block).any(axis=1))
+            if len(empty):
+                # If there is no path from one node, there is no path from any node
+                block = block[: empty[0]]
+                searching.discard(k)
+            if not block.size:
+                continue
+            row, col = np.unravel_index(np.argmin(block), block.shape)
+            if np.isfinite(block[row, col]) and (
+                k not in best or block[row, col] < best[k][2]
+            ):
+                best[k] = (
+                    int(sources[row]),
+                    int(members[others[k]][col]),
+                    float(block[row, col]),
+                )
+    return {others[k]: best[k] for k in sorted(best)}
+
+
+def closest_cluster_nodes_heuristic(G, centroid, c1_indices, others, members):
+    """Like closest_cluster_nodes, but only looks at the paths from the
+    centroid of cluster 1 to each c2 in others, then from the closest c2 node
+    back to all nodes of cluster 1. Of the cluster 1 nodes at most as far as
+    the c2 node from the centroid (up to rounding), the last closest one wins.
+    The search stops at the first c2 that cannot be reached.
+    """
+    targets = (
+        np.concatenate([members[c2] for c2 in others])
+        if others
+        else np.empty(0, dtype=np.int64)
+    )
+    bounds = np.cumsum([0] + [len(members[c2]) for c2 in others])
+    dist = _path_distances(G, [centroid], targets.tolist())[0]
+
+    # Closest c2 node to the centroid of cluster 1
+    closest = []
+    for k in range(len(others)):
+        block = dist[bounds[k] : bounds[k + 1]]
+        if not np.isfinite(block).any():
+            # If there is no path from one node, there is no path from any node
+            break
+        col = int(np.argmin(block))
+        node = vertex_index(G, G.vs[int(members[others[k]][col])]["id"])
+        closest.append((node, float(block[col])))
+    if not closest:
+        return {}
+
+    # Now find all c1 nodes to that closest c2 node
+    nodes = sorted({node for node, _ in closest})
+    rows = dict(zip(nodes, _path_distances(G, nodes, c1_indices.tolist())))
+    result = {}
+    for k, (node, min_dist) in enumerate(closest):
+        back = rows[node]
+        if not np.isfinite(back).any():
+            break
+        # The way back can be longer in the last bits when the centroid is
+        # the closest c1 node, as the weights are summed in the other order
+        tolerance = 1e-9 * max(1.0, min_dist)
+        best = back.min()
+        if best > min_dist + tolerance:
+            continue
+        last = np.flatnonzero(back <= best + tolerance)[-1]
+        result[others[k]] = (int(c1_indices[last]), node, float(back[last]))
+    return result
 
 
 def clusterpairs_by_distance(
@@ -897,17 +1958,20 @@ def clusterpairs_by_distance(
         clusterinfo, False
     )  # Start with the smallest so the for loop is as short as possible
     clusterpairs = []
-    clustercopies = {}
 
-    # Create copies of all clusters
-    for i in range(len(cluster_indices)):
-        clustercopies[i] = clusters[i].copy()
+    # Vertex indices of G_total in each cluster, ascending
+    id_map = vertex_id_map(G_total)
+    members = {}
+    for c in cluster_indices:
+        indices = [id_map.get(v) for v in clusters[c].vs["id"]]
+        members[c] = np.unique(
+            np.array([i for i in indices if i is not None], dtype=np.int64)
+        )
+    ids = G_total.vs["id"]
 
     # Take one cluster
     for i, c1 in enumerate(cluster_indices[:-1]):
-        c1_indices = G_total.vs.select(
-            lambda x: x["id"] in clustercopies[c1].vs()["id"]
-        ).indices
+        c1_indices = members[c1]
         print(
             "Working on cluster "
             + str(i + 1)
@@ -915,82 +1979,25 @@ def clusterpairs_by_distance(
             + str(len(cluster_indices))
             + "..."
         )
-        for j, c2 in enumerate(cluster_indices[i + 1 :]):
-            closest_pair = {"i": -1, "j": -1}
-            min_dist = np.inf
-            c2_indices = G_total.vs.select(
-                lambda x: x["id"] in clustercopies[c2].vs()["id"]
-            ).indices
-            if verbose:
-                print(
-                    "... routing "
-                    + str(len(c1_indices))
-                    + " nodes to "
-                    + str(len(c2_indices))
-                    + " nodes in other cluster "
-                    + str(j + 1)
-                    + " of "
-                    + str(len(cluster_indices[i + 1 :]))
-                    + "."
-                )
-
-            if full_run:
-                # Compare all pairs of nodes in both clusters (takes long)
-                for a in list(c1_indices):
-                    sp = G_total.get_shortest_paths(
-                        a, c2_indices, weights="weight", output="epath"
-                    )
-
-                    if all([not elem for elem in sp]):
-                        # If there is no path from one node, there is no path from any node
-                        break
-                    else:
-                        for path, c2_index in zip(sp, c2_indices):
-                            if len(path) >= 1:
-                                dist_nodes = sum(
-                                    [G_total.es[e]["weight"] for e in path]
-                                )
-                                if dist_nodes < min_dist:
-                                    closest_pair["i"] = G_total.vs[a]["id"]
-                                    closest_pair["j"] = G_total.vs[c2_index]["id"]
-                                    min_dist = dist_nodes
-            else:
-                # Do a heuristic that should be close enough.
-                # From cluster 1, look at all shortest paths only from its centroid
-                a = clusterinfo[c1]["centroid_index"]
-                sp = G_total.get_shortest_paths(
-                    a, c2_indices, weights="weight", output="epath"
-                )
-                if all([not elem for elem in sp]):
-                    # If there is no path from one node, there is no path from any node
-                    break
-                else:
-                    for path, c2_index in zip(sp, c2_indices):
-                        if len(path) >= 1:
-                            dist_nodes = sum([G_total.es[e]["weight"] for e in path])
-                            if dist_nodes < min_dist:
-                                closest_pair["j"] = G_total.vs[c2_index]["id"]
-                                min_dist = dist_nodes
-                # Closest c2 node to centroid1 found. Now find all c1 nodes to that closest c2 node.
-                b = G_total.vs.find(id=closest_pair["j"]).index
-                sp = G_total.get_shortest_paths(
-                    b, c1_indices, weights="weight", output="epath"
-                )
-                if all([not elem for elem in sp]):
-                    # If there is no path from one node, there is no path from any node
-                    break
-                else:
-                    for path, c1_index in zip(sp, c1_indices):
-                        if len(path) >= 1:
-                            dist_nodes = sum([G_total.es[e]["weight"] for e in path])
-                            if dist_nodes <= min_dist:  # <=, not <!
-                                closest_pair["i"] = G_total.vs[c1_index]["id"]
-                                min_dist = dist_nodes
-
-            if closest_pair["i"] != -1 and closest_pair["j"] != -1:
-                clusterpairs.append(
-                    [(c1, c2), (closest_pair["i"], closest_pair["j"]), min_dist]
-                )
+        others = cluster_indices[i + 1 :]
+        if verbose:
+            print(
+                "... routing "
+                + str(len(c1_indices))
+                + " nodes to "
+                + str(sum(len(members[c2]) for c2 in others))
+                + " nodes in "
+                + str(len(others))
+                + " other clusters."
+            )
+        if full_run:
+            closest = closest_cluster_nodes(G_total, c1_indices, others, members)
+        else:
+            closest = closest_cluster_nodes_heuristic(
+                G_total, clusterinfo[c1]["centroid_index"], c1_indices, others, members
+            )
+        for c2, (a, b, min_dist) in closest.items():
+            clusterpairs.append([(c1, c2), (ids[a], ids[b]), min_dist])
 
     clusterpairs.sort(key=lambda x: x[-1])
     if return_distances:
@@ -999,7 +2006,454 @@ def clusterpairs_by_distance(
         return [[o[0], o[1]] for o in clusterpairs]
 
 
-def mst_routing(G, G_carall, pois):
+class ContractedGraph:
+    """Routing graph of G with its chains of degree-2 vertices contracted into
+    single edges. The vertex indices keep (e.g. the POIs) and every vertex of
+    another degree stay vertices, so shortest paths between them can be found
+    on the much smaller graph H and expanded back into vertex paths of G.
+    Each edge of H weighs the sum of the weights of its chain and keeps the
+    chain as vertex indices of G. Distances agree with G's up to floating
+    point rounding; among equally short paths another one may be chosen.
+    """
+
+    def __init__(self, G, keep=(), weights="weight"):
+        self.G = G
+        degree = np.asarray(G.degree(), dtype=np.int64)
+        contract = degree == 2
+        contract[list(keep)] = False
+        edges = G.get_edgelist()
+        loops = [edge for edge, (u, v) in enumerate(edges) if u == v]
+        contract[[edges[edge][0] for edge in loops]] = False
+        weight = G.es[weights]
+        incident = G.get_inclist()
+
+        kept = np.flatnonzero(~contract)
+        self.position = np.full(G.vcount(), -1, dtype=np.int64)
+        self.position[kept] = np.arange(len(kept))
+        self.chains, chain_edges, chain_weights = [], [], []
+        for u in kept.tolist():
+            for first in incident[u]:
+                chain = [u]
+                edge, v, total = first, u, 0.0
+                while True:
+                    a, b = edges[edge]
+                    v = b if a == v else a
+                    chain.append(v)
+                    total += weight[edge]
+                    if not contract[v]:
+                        break
+                    e1, e2 = incident[v]
+                    edge = e2 if e1 == edge else e1
+                # Each chain is walked from both ends, keep one of them
+                if v == u or (edge, v) < (first, u):
+                    continue
+                self.chains.append(np.asarray(chain, dtype=np.int64))
+                chain_edges.append((self.position[u], self.position[v]))
+                chain_weights.append(total)
+        self.H = ig.Graph(len(kept), edges=chain_edges, directed=False)
+        self.H.es["weight"] = chain_weights
+
+    def distance_matrix(self, sources, targets, workers=None) -> np.ndarray:
+        """distance_matrix on H for the kept vertex indices of G."""
+        return distance_matrix(
+            self.H,
+            self.position[list(sources)].tolist(),
+            self.position[list(targets)].tolist(),
+            workers,
+        )
+
+    def get_shortest_path(self, source, target) -> np.ndarray:
+        """Vertex indices of G of a shortest path between kept vertices of G."""
+        path = [source]
+        for edge in self.H.get_shortest_paths(
+            self.position[source],
+            self.position[target],
+            weights="weight",
+            output="epath",
+        )[0]:
+            chain = self.chains[edge]
+            path.extend(chain[1:] if chain[0] == path[-1] else chain[-2::-1])
+        if len(path) == 1 and source != target:
+            path = []  # Not reachable
+        return np.asarray(path, dtype=np.int64)
+
+
+def _ch_shortcuts(adj, v, max_settled):
+    """Shortcuts needed to contract vertex v of the remaining graph adj
+    (a dict neighbour -> (weight, edge key) per vertex), as tuples
+    (u, w, weight, key of v-u, key of v-w). A pair of neighbours needs none
+    if a witness search from u, avoiding v and settling at most max_settled
+    vertices, finds a path to w that is no longer than the one through v.
+    """
+    neighbours = list(adj[v].items())
+    shortcuts = []
+    for i, (u, (weight_u, key_u)) in enumerate(neighbours):
+        others = neighbours[i + 1 :]
+        if not others:
+            break
+        bound = weight_u + max(weight for _, (weight, _) in others)
+        remaining = {w for w, _ in others}
+        dist = {u: 0.0}
+        heap = [(0.0, u)]
+        settled = 0
+        while heap and remaining and settled < max_settled:
+            d, x = heapq.heappop(heap)
+            if d > dist[x]:
+                continue
+            if d > bound:
+                break
+            remaining.discard(x)
+            settled += 1
+            for y, (weight, _) in adj[x].items():
+                if y != v and d + weight < dist.get(y, math.inf):
+                    dist[y] = d + weight
+                    heapq.heappush(heap, (d + weight, y))
+        for w, (weight_w, key_w) in others:
+            if dist.get(w, math.inf) > weight_u + weight_w:
+                shortcuts.append((u, w, weight_u + weight_w, key_u, key_w))
+    return shortcuts
+
+
+class ContractionHierarchy:
+    """Contraction hierarchy of an undirected weighted graph G for many-to-many
+    distances and point-to-point shortest paths between vertex indices of G,
+    with the same interface as ContractedGraph.
+    Vertices are contracted one by one in the order of their edge difference,
+    adding shortcut edges between the neighbours they connect. A query only
+    searches upwards in that order from both ends, which settles a small part
+    of the graph. Shortcuts are unpacked into vertex paths of G.
+    Distances agree with G's up to floating point rounding; among equally
+    short paths another one may be chosen.
+    Build it with build, or load and persist it with contraction_hierarchy.
+    The upward searches of the last max_searches path query ends are kept.
+    """
+
+    def __init__(self, arrays, max_searches=1024):
+        self.arrays = arrays
+        # Upward edges from each vertex, as CSR lists for fast searches
+        self.ptr = arrays["ptr"].tolist()
+        self.up_from = arrays["up_from"].tolist()
+        self.up_to = arrays["up_to"].tolist()
+        self.up_weight = arrays["up_weight"].tolist()
+        self.up_key = arrays["up_key"].tolist()
+        self.ends = arrays["ends"].tolist()
+        self.mid = arrays["mid"].tolist()
+        self.children = arrays["children"].tolist()
+        self.max_searches = max_searches
+        self._searches = OrderedDict()  # LRU of upward searches by source
+
+    @classmethod
+    def build(cls, G, weights="weight", max_settled=64):
+        """Contract every vertex of G."""
+        n = G.vcount()
+        adj = [{} for _ in range(n)]
+        # Every edge ever made: its ends, middle vertex and the two edges
+        # (middle to each end) of a shortcut, -1 for the edges of G
+        ends, mid, children = [], [], []
+        for (a, b), weight in zip(G.get_edgelist(), G.es[weights]):
+            if a == b or adj[a].get(b, (math.inf,))[0] <= weight:
+                continue
+            adj[a][b] = adj[b][a] = (weight, len(ends))
+            ends.append((a, b))
+            mid.append(-1)
+            children.append((-1, -1))
+
+        contracted_neighbours = [0] * n
+
+        def priority(v):
+            shortcuts = _ch_shortcuts(adj, v, max_settled)
+            return len(shortcuts) - len(adj[v]) + contracted_neighbours[v]
+
+        heap = [(priority(v), v) for v in range(n)]
+        heapq.heapify(heap)
+        rank = np.full(n, -1, dtype=np.int64)
+        up = [[] for _ in range(n)]
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if rank[v] >= 0:
+                continue
+            # Lazy update: contract v only if it is still the cheapest, which
+            # keeps the priorities current without updating the neighbours
+            current = priority(v)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, v))
+                continue
+            shortcuts = _ch_shortcuts(adj, v, max_settled)
+            rank[v] = order
+            order += 1
+            up[v] = [(u, weight, key) for u, (weight, key) in adj[v].items()]
+            for u in adj[v]:
+                del adj[u][v]
+                contracted_neighbours[u] += 1
+            adj[v] = {}
+            for u, w, weight, key_u, key_w in shortcuts:
+                if adj[u].get(w, (math.inf,))[0] <= weight:
+                    continue
+                adj[u][w] = adj[w][u] = (weight, len(ends))
+                ends.append((u, w))
+                mid.append(v)
+                children.append((key_u, key_w))
+
+        sizes = np.array([len(edges) for edges in up], dtype=np.int64)
+        edges = [edge for edges in up for edge in edges]
+        return cls(
+            {
+                "ids": np.asarray(G.vs["id"], dtype=np.int64),
+                "rank": rank,
+                "ptr": np.concatenate(([0], np.cumsum(sizes))),
+                "up_from": np.repeat(np.arange(n, dtype=np.int64), sizes),
+                "up_to": np.array([u for u, _, _ in edges], dtype=np.int64),
+                "up_weight": np.array([w for _, w, _ in edges], dtype=np.float64),
+                "up_key": np.array([k for _, _, k in edges], dtype=np.int64),
+                "ends": np.array(ends, dtype=np.int64).reshape(-1, 2),
+                "mid": np.array(mid, dtype=np.int64),
+                "children": np.array(children, dtype=np.int64).reshape(-1, 2),
+            }
+        )
+
+    def _upward(self, source, keep=True):
+        """Distances and parent upward edges of the upward search from source.
+        If keep, the search is kept for later queries.
+        """
+        search = self._searches.get(source)
+        if search is not None:
+            self._searches.move_to_end(source)
+            return search
+        dist, parent = {source: 0.0}, {source: -1}
+        heap = [(0.0, source)]
+        ptr, up_to, up_weight = self.ptr, self.up_to, self.up_weight
+        while heap:
+            d, x = heapq.heappop(heap)
+            if d > dist[x]:
+                continue
+            for i in range(ptr[x], ptr[x + 1]):
+                y = up_to[i]
+                if d + up_weight[i] < dist.get(y, math.inf):
+                    dist[y] = d + up_weight[i]
+                    parent[y] = i
+                    heapq.heappush(heap, (d + up_weight[i], y))
+        if keep:
+            self._searches[source] = dist, parent
+            if len(self._searches) > self.max_searches:
+                self._searches.popitem(last=False)
+        return dist, parent
+
+    def distance_matrix(self, sources, targets, workers=None) -> np.ndarray:
+        """Matrix of the shortest path distances from the vertex indices
+        sources (rows) to targets (columns), inf where there is no path.
+        The upward searches of the targets are kept in buckets per vertex,
+        and each source's search is matched against them. The searches are
+        only kept for this call.
+        """
+        sources, targets = list(sources), list(targets)
+        dist = np.full((len(sources), len(targets)), np.inf)
+        if not sources or not targets:
+            return dist
+        spaces = {}  # Upward search space of each vertex, as (vertices, distances)
+        for v in dict.fromkeys(targets + sources):
+            space = self._upward(v, keep=False)[0]
+            spaces[v] = (
+                np.fromiter(space.keys(), np.int64, len(space)),
+                np.fromiter(space.values(), np.float64, len(space)),
+            )
+        nodes, columns, lengths = [], [], []
+        for j, target in enumerate(targets):
+            space_nodes, space_lengths = spaces[target]
+            nodes.append(space_nodes)
+            lengths.append(space_lengths)
+            columns.append(np.full(len(space_nodes), j, dtype=np.int64))
+        nodes, columns, lengths = map(np.concatenate, (nodes, columns, lengths))
+        order = np.argsort(nodes, kind="stable")
+        nodes, columns, lengths = nodes[order], columns[order], lengths[order]
+        for i, source in enumerate(sources):
+            meet, up = spaces[source]
+            start = np.searchsorted(nodes, meet, "left")
+            count = np.searchsorted(nodes, meet, "right") - start
+            if not count.any():
+                continue
+            # Bucket entries of every vertex of the source's search
+            offsets = np.arange(count.sum()) - np.repeat(
+                np.cumsum(count) - count, count
+            )
+            entries = np.repeat(start, count) + offsets
+            np.minimum.at(
+                dist[i], columns[entries], np.repeat(up, count) + lengths[entries]
+            )
+        return dist
+
+    def _unpack(self, key, start, path):
+        """Append the vertices of edge key from its end start to path."""
+        stack = [(key, start)]
+        while stack:
+            key, start = stack.pop()
+            a, b = self.ends[key]
+            if self.mid[key] < 0:
+                path.append(b if start == a else a)
+                continue
+            key_a, key_b = self.children[key]
+            if start == a:
+                stack += [(key_b, self.mid[key]), (key_a, a)]
+            else:
+                stack += [(key_a, self.mid[key]), (key_b, b)]
+
+    def get_shortest_path(self, source, target) -> np.ndarray:
+        """Vertex indices of G of a shortest path from source to target."""
+        forward, forward_parent = self._upward(source)
+        backward, backward_parent = self._upward(target)
+        common = forward.keys() & backward.keys()
+        if not common:
+            return np.empty(0, dtype=np.int64)  # Not reachable
+        meet = min(common, key=lambda v: (forward[v] + backward[v], v))
+        # Upward edges from source to meet, then down from meet to target
+        up_edges = []
+        v = meet
+        while forward_parent[v] >= 0:
+            up_edges.append(forward_parent[v])
+            v = self.up_from[forward_parent[v]]
+        path = [source]
+        for i in reversed(up_edges):
+            self._unpack(self.up_key[i], self.up_from[i], path)
+        v = meet
+        while backward_parent[v] >= 0:
+            i = backward_parent[v]
+            self._unpack(self.up_key[i], v, path)
+            v = self.up_from[i]
+        return np.asarray(path, dtype=np.int64)
+
+
+def contraction_hierarchy(p: Path, placeid: str, parameterid: str = "carall", G=None):
+    """Return the ContractionHierarchy of the graph parameterid of placeid,
+    persisted next to its files as {placeid}_{parameterid}_ch.npz. It is
+    rebuilt (from G if given, else from the files) when the graph files
+    changed since it was written, see graph_source_version.
+    """
+    ch_path = p / f"{placeid}_{parameterid}_ch.npz"
+    signature = json.dumps(graph_source_version(p, placeid, parameterid))
+    try:
+        with np.load(ch_path) as data:
+            if str(data["signature"]) == signature:
+                ch = ContractionHierarchy(
+                    {key: data[key] for key in data.files if key != "signature"}
+                )
+                if G is None or np.array_equal(ch.arrays["ids"], G.vs["id"]):
+                    return ch
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        pass  # Missing, truncated or corrupt: rebuilt below
+
+    if G is None:
+        G = csv_to_ig(p, placeid, parameterid)
+    ch = ContractionHierarchy.build(G)
+    # Written aside and renamed, so concurrent runs never read a partial file
+    partial = p / f".{ch_path.stem}.{os.getpid()}.{threading.get_ident()}.npz"
+    np.savez(partial, signature=np.array(signature), **ch.arrays)
+    os.replace(partial, ch_path)
+    return ch
+
+
+class PathCache:
+    """Shortest vertex paths on a graph G keyed by (source, target) vertex
+    index. Paths are computed on first use only, so each POI pair is routed
+    once and only if it is needed. Both directions are kept apart, so ties
+    between equally short paths resolve exactly as
+    G.get_shortest_paths(source, target).
+    With a ContractedGraph or ContractionHierarchy of G, the paths are routed
+    on it instead.
+    """
+
+    def __init__(self, G, weights="weight", contracted=None):
+        self.G = G
+        self.weights = weights
+        self.contracted = contracted
+        self.paths = {}
+
+    def get(self, source, target) -> np.ndarray:
+        """Vertex indices of the shortest path from source to target."""
+        path = self.paths.get((source, target))
+        if path is None and self.contracted is not None:
+            path = self.contracted.get_shortest_path(source, target)
+            self.paths[(source, target)] = path
+        elif path is None:
+            path = np.asarray(
+                self.G.get_shortest_paths(
+                    source, target, weights=self.weights, output="vpath"
+                )[0],
+                dtype=np.int64,
+            )
+            self.paths[(source, target)] = path
+        return path
+
+    def vertex_mask(self, pairs) -> np.ndarray:
+        """Boolean mask over the vertices of G covered by the shortest paths
+        between the given (source, target) vertex index pairs.
+        """
+        mask = np.zeros(self.G.vcount(), dtype=bool)
+        for source, target in pairs:
+            mask[self.get(source, target)] = True
+        return mask
+
+
+def edgeless_subgraph(G, indices):
+    """G.subgraph(indices) without its edges, built from the vertex attributes
+    only: the vertices keep their attributes and G's edge attributes exist,
+    empty. Used as the abstract graph of a set of POIs.
+    """
+    indices = sorted(set(indices))
+    H = ig.Graph(len(indices), directed=G.is_directed())
+    for attribute in G.attributes():
+        H[attribute] = G[attribute]
+    for attribute in G.vs.attributes():
+        values = G.vs[attribute]
+        H.vs[attribute] = [values[i] for i in indices]
+    for attribute in G.es.attributes():
+        H.es[attribute] = []
+    return H
+
+
+def route_abstract_edges(G, G_abstract, path_cache):
+    """Induced subgraph of G on the shortest paths between the end nodes
+    (matched by id) of every edge of G_abstract.
+    """
+    ids = G_abstract.vs["id"] if G_abstract.vcount() else []
+    pairs = [
+        (vertex_index(G, ids[source]), vertex_index(G, ids[target]))
+        for source, target in G_abstract.get_edgelist()
+    ]
+    return G.induced_subgraph(np.flatnonzero(path_cache.vertex_mask(pairs)).tolist())
+
+
+def minimum_spanning_edges(dist):
+    """Minimum spanning forest of the dense symmetric distance matrix dist
+    (np.inf where not connected) with Prim's algorithm. Each tree is grown
+    from its smallest vertex, like igraph's spanning_tree does. Returns the
+    arrays (parents, children) of the edges in the order they were added.
+    With distinct distances the forest equals igraph's; among tied distances
+    the smallest vertex is chosen.
+    """
+    n = len(dist)
+    best = np.full(n, np.inf)  # Distance of each vertex to the current tree
+    parent = np.full(n, -1, dtype=np.int64)
+    in_tree = np.zeros(n, dtype=bool)
+    parents, children = [], []
+    vertex = 0
+    for _ in range(n):
+        in_tree[vertex] = True
+        if parent[vertex] >= 0:
+            parents.append(parent[vertex])
+            children.append(vertex)
+        closer = ~in_tree & (dist[vertex] < best)
+        best[closer] = dist[vertex][closer]
+        parent[closer] = vertex
+        candidates = np.where(in_tree, np.inf, best)
+        vertex = int(np.argmin(candidates))
+        if candidates[vertex] == np.inf:
+            if in_tree.all():
+                break
+            vertex = int(np.argmin(in_tree))  # Start the next tree
+    return np.array(parents, dtype=np.int64), np.array(children, dtype=np.int64)
+
+
+def mst_routing(G, G_carall, pois, path_cache=None, distances=None):
     """Minimum Spanning Tree (MST) of a graph G's node subset pois,
     then routing to connect the MST.
     G is an ipgraph graph, pois is a list of node ids.
@@ -1009,50 +2463,49 @@ def mst_routing(G, G_carall, pois):
 
     Distance here is routing distance, while edge crossing is checked on an abstract
     level.
+    A PathCache of G can be passed to reuse the paths of an earlier routing,
+    and the poipair_arrays of pois as distances to skip computing them.
     """
 
     if len(pois) < 2:
         return (ig.Graph(), ig.Graph())  # We can't do anything with less than 2 POIs
 
     # MST_abstract is the MST with same nodes but euclidian links
-    pois_indices = set()
-    for poi in pois:
-        pois_indices.add(G.vs.find(id=poi).index)
-    G_temp = copy.deepcopy(G)
-    for e in G_temp.es:  # delete all edges
-        G_temp.es.delete(e)
-
-    poipairs = poipairs_by_distance(G, G_carall, pois, True)
-    if len(poipairs) == 0:
-        return (ig.Graph(), ig.Graph())
+    pois_indices = vertex_indices(G, pois)
 
-    MST_abstract = copy.deepcopy(G_temp.subgraph(pois_indices))
-    for poipair, poipair_distance in poipairs:
-        poipair_ind = (
-            MST_abstract.vs.find(id=poipair[0]).index,
-            MST_abstract.vs.find(id=poipair[1]).index,
-        )
-        MST_abstract.add_edge(poipair_ind[0], poipair_ind[1], weight=poipair_distance)
-    MST_abstract = MST_abstract.spanning_tree(weights="weight")
+    if distances is None:
+        distances = poipair_arrays(G, G_carall, pois)
+    sources, targets, distances = distances
+    if len(distances) == 0:
+        return (ig.Graph(), ig.Graph())
 
-    # Get node pairs we need to route, sorted by distance
-    routenodepairs = {}
-    for e in MST_abstract.es:
-        routenodepairs[(e.source_vertex["id"], e.target_vertex["id"])] = e["weight"]
-    routenodepairs = sorted(routenodepairs.items(), key=lambda x: x[1])
+    MST_abstract = edgeless_subgraph(G, pois_indices)
+    # Pairs as vertex indices of MST_abstract, matched by id
+    ends, inverse = np.unique(np.concatenate((sources, targets)), return_inverse=True)
+    ids = G.vs["id"]
+    ends = np.asarray(vertex_indices(MST_abstract, [ids[v] for v in ends.tolist()]))
+    first, second = np.split(ends[inverse], 2)
+    # Repeated pois can pair two vertices twice, the shorter (first) pair wins
+    n = MST_abstract.vcount()
+    _, unique = np.unique(
+        np.minimum(first, second) * n + np.maximum(first, second), return_index=True
+    )
+    unique.sort()
+    first, second, distances = first[unique], second[unique], distances[unique]
+    dist = np.full((n, n), np.inf)
+    dist[first, second] = dist[second, first] = distances
+    pair = np.full(dist.shape, -1, dtype=np.int64)
+    pair[first, second] = pair[second, first] = np.arange(len(first))
+    parents, children = minimum_spanning_edges(dist)
+    # Keep the edge order of the pairs, as spanning_tree would
+    tree = np.sort(pair[parents, children])
+    MST_abstract.add_edges(
+        np.column_stack((first[tree], second[tree])).tolist(),
+        attributes={"weight": distances[tree].tolist()},
+    )
 
     # Do the routing
-    MST_indices = set()
-    for poipair, poipair_distance in routenodepairs:
-        poipair_ind = (G.vs.find(id=poipair[0]).index, G.vs.find(id=poipair[1]).index)
-        sp = set(
-            G.get_shortest_paths(
-                poipair_ind[0], poipair_ind[1], weights="weight", output="vpath"
-            )[0]
-        )
-        MST_indices = MST_indices.union(sp)
-
-    MST = G.induced_subgraph(MST_indices)
+    MST = route_abstract_edges(G, MST_abstract, path_cache or PathCache(G))
 
     return (MST, MST_abstract)
 
@@ -1068,55 +2521,70 @@ def greedy_triangulation(
     graph, while minimizing the total length of edges considered.
     See: cardillo2006spp
     """
+    return greedy_triangulation_quantiles(
+        GT, poipairs, [prune_quantile], prune_measure, edgeorder
+    )[0]
 
-    for poipair, poipair_distance in poipairs:
-        poipair_ind = (GT.vs.find(id=poipair[0]).index, GT.vs.find(id=poipair[1]).index)
-        if not new_edge_intersects(
-            GT,
-            (
-                GT.vs[poipair_ind[0]]["x"],
-                GT.vs[poipair_ind[0]]["y"],
-                GT.vs[poipair_ind[1]]["x"],
-                GT.vs[poipair_ind[1]]["y"],
-            ),
-        ):
-            GT.add_edge(poipair_ind[0], poipair_ind[1], weight=poipair_distance)
+
+def greedy_triangulation_quantiles(
+    GT, poipairs, prune_quantiles=[1], prune_measure="betweenness", edgeorder=False
+):
+    """Greedy Triangulation (GT) of a graph GT with an empty edge set, pruned
+    to each of prune_quantiles as greedy_triangulation does. The triangulation
+    and the prune measure are computed only once and every pruned GT is a
+    threshold of them. Returns the list of pruned GTs.
+    If prune_measure is random and no edgeorder is given, the edges are
+    shuffled with a constant seed.
+    """
+    add_greedy_triangulation_edges(GT, poipairs)
 
     # Get the measure for pruning
     if prune_measure == "betweenness":
         BW = GT.edge_betweenness(directed=False, weights="weight")
-        qt = np.quantile(BW, 1 - prune_quantile)
-        sub_edges = []
-        for c, e in enumerate(GT.es):
-            if BW[c] >= qt:
-                sub_edges.append(c)
-            GT.es[c]["bw"] = BW[c]
-            GT.es[c]["width"] = math.sqrt(BW[c] + 1) * 0.5
+        GT.es["bw"] = BW
+        GT.es["width"] = [math.sqrt(bw + 1) * 0.5 for bw in BW]
+        BW = np.asarray(BW)
         # Prune
-        GT = GT.subgraph_edges(sub_edges)
+        return [
+            GT.subgraph_edges(
+                np.flatnonzero(BW >= np.quantile(BW, 1 - prune_quantile)).tolist()
+            )
+            for prune_quantile in prune_quantiles
+        ]
     elif prune_measure == "closeness":
         CC = GT.closeness(vertices=None, weights="weight")
-        qt = np.quantile(CC, 1 - prune_quantile)
-        sub_nodes = []
-        for c, v in enumerate(GT.vs):
-            if CC[c] >= qt:
-                sub_nodes.append(c)
-            GT.vs[c]["cc"] = CC[c]
-        GT = GT.induced_subgraph(sub_nodes)
-    elif prune_measure == "random":
-        ind = (
-            np.quantile(
-                np.arange(len(edgeorder)), prune_quantile, interpolation="lower"
+        GT.vs["cc"] = CC
+        CC = np.asarray(CC)
+        return [
+            GT.induced_subgraph(
+                np.flatnonzero(CC >= np.quantile(CC, 1 - prune_quantile)).tolist()
             )
-            + 1
-        )  # "lower" and + 1 so smallest quantile has at least one edge
-        GT = GT.subgraph_edges(edgeorder[:ind])
+            for prune_quantile in prune_quantiles
+        ]
+    elif prune_measure == "random":
+        if edgeorder is False:
+            random.seed(0)  # const seed for reproducibility
+            edgeorder = random.sample(range(GT.ecount()), k=GT.ecount())
+        GTs = []
+        for prune_quantile in prune_quantiles:
+            ind = (
+                np.quantile(np.arange(len(edgeorder)), prune_quantile, method="lower")
+                + 1
+            )  # "lower" and + 1 so smallest quantile has at least one edge
+            GTs.append(GT.subgraph_edges(edgeorder[:ind]))
+        return GTs
 
-    return GT
+    return [GT.copy() for _ in prune_quantiles]
 
 
 def greedy_triangulation_routing(
-    G, G_carall, pois, prune_quantiles=[1], prune_measure="betweenness"
+    G,
+    G_carall,
+    pois,
+    prune_quantiles=[1],
+    prune_measure="betweenness",
+    path_cache=None,
+    distances=None,
 ):
     """Greedy Triangulation (GT) of a graph G's node subset pois,
     then routing to connect the GT (up to a quantile of betweenness
@@ -1130,87 +2598,157 @@ def greedy_triangulation_routing(
 
     Distance here is routing distance, while edge crossing is checked on an abstract
     level.
+    A PathCache of G can be passed to reuse the paths of an earlier routing,
+    and the poipair_arrays of pois as distances to skip computing them.
     """
 
     if len(pois) < 2:
         return ([], [])  # We can't do anything with less than 2 POIs
     # GT_abstract is the GT with same nodes but euclidian links to keep track of edge crossings
-    pois_indices = set()
-    for poi in pois:
-        pois_indices.add(G.vs.find(id=poi).index)
-    G_temp = copy.deepcopy(G)
-    for e in G_temp.es:  # delete all edges
-        G_temp.es.delete(e)
-
-    poipairs = poipairs_by_distance(G, G_carall, pois, True)
+    pois_indices = vertex_indices(G, pois)
+
+    if distances is None:
+        distances = poipair_arrays(G, G_carall, pois)
+    poipairs = poipairs_from_arrays(G, *distances, return_distances=True)
     if len(poipairs) == 0:
         return ([], [])
 
-    if prune_measure == "random":
-        # run the whole GT first
-        GT = copy.deepcopy(G_temp.subgraph(pois_indices))
-        for poipair, poipair_distance in poipairs:
-            poipair_ind = (
-                GT.vs.find(id=poipair[0]).index,
-                GT.vs.find(id=poipair[1]).index,
-            )
-            if not new_edge_intersects(
-                GT,
-                (
-                    GT.vs[poipair_ind[0]]["x"],
-                    GT.vs[poipair_ind[0]]["y"],
-                    GT.vs[poipair_ind[1]]["x"],
-                    GT.vs[poipair_ind[1]]["y"],
-                ),
-            ):
-                GT.add_edge(poipair_ind[0], poipair_ind[1], weight=poipair_distance)
-        # create a random order for the edges
-        random.seed(0)  # const seed for reproducibility
-        edgeorder = random.sample(range(GT.ecount()), k=GT.ecount())
-    else:
-        edgeorder = False
+    # Triangulate once, all quantiles are prunings of the same GT
+    GT_abstracts = greedy_triangulation_quantiles(
+        edgeless_subgraph(G, pois_indices),
+        poipairs,
+        prune_quantiles,
+        prune_measure,
+    )
 
-    GT_abstracts = []
-    GTs = []
-    for prune_quantile in tqdm(
-        prune_quantiles, desc="Greedy triangulation", leave=False
-    ):
-        GT_abstract = copy.deepcopy(G_temp.subgraph(pois_indices))
-        GT_abstract = greedy_triangulation(
-            GT_abstract, poipairs, prune_quantile, prune_measure, edgeorder
+    # Do the routing, every POI pair is routed once for all quantiles
+    path_cache = path_cache or PathCache(G)
+    GTs = [
+        route_abstract_edges(G, GT_abstract, path_cache)
+        for GT_abstract in tqdm(GT_abstracts, desc="Greedy triangulation", leave=False)
+    ]
+
+    return (GTs, GT_abstracts)
+
+
+class CandidateDistances:
+    """Network distances between the candidate nodes of a city, the carall
+    nodes its H3 hexagon centroids snap to, read from a memory-mapped matrix
+    written by write_candidate_distances. Has the distance_matrix interface of
+    ContractedGraph for vertex indices of G that are candidates.
+    """
+
+    def __init__(self, G, ids, matrix):
+        self.matrix = matrix
+        self.position = np.full(G.vcount(), -1, dtype=np.int64)
+        self.position[vertex_indices(G, ids.tolist())] = np.arange(len(ids))
+
+    def covers(self, indices) -> bool:
+        """Whether all vertex indices are candidates."""
+        return bool((self.position[list(indices)] >= 0).all())
+
+    def distance_matrix(self, sources, targets, workers=None) -> np.ndarray:
+        """Submatrix of the distances from sources (rows) to targets (columns)."""
+        return np.array(
+            self.matrix[
+                np.ix_(self.position[list(sources)], self.position[list(targets)])
+            ]
         )
-        GT_abstracts.append(GT_abstract)
-
-        # Get node pairs we need to route, sorted by distance
-        routenodepairs = {}
-        for e in GT_abstract.es:
-            routenodepairs[(e.source_vertex["id"], e.target_vertex["id"])] = e["weight"]
-        routenodepairs = sorted(routenodepairs.items(), key=lambda x: x[1])
-
-        # Do the routing
-        GT_indices = set()
-        for poipair, poipair_distance in routenodepairs:
-            poipair_ind = (
-                G.vs.find(id=poipair[0]).index,
-                G.vs.find(id=poipair[1]).index,
-            )
-            sp = set(
-                G.get_shortest_paths(
-                    poipair_ind[0], poipair_ind[1], weights="weight", output="vpath"
-                )[0]
-            )
-            GT_indices = GT_indices.union(sp)
 
-        GT = G.induced_subgraph(GT_indices)
-        GTs.append(GT)
 
-    return (GTs, GT_abstracts)
+def _candidate_distances_paths(p: Path, placeid: str, h3_zoom: int):
+    prefix = f"{placeid}_h3_{h3_zoom}_candidates"
+    return p / f"{prefix}.npz", p / f"{prefix}.npy"
 
 
-def poipairs_by_distance(G, G_carall, pois, return_distances=False):
+def read_candidate_distances(p: Path, placeid: str, h3_zoom: int, G, hexes=None):
+    """Return the CandidateDistances of placeid at h3_zoom on its carall graph G,
+    or None if there are none, the carall files changed since they were
+    written, or (if given) they were written for other hexes, a key of the
+    hexagons and snapping as made by write_candidate_distances.
+    Runs need not pass hexes: the distances depend only on the carall graph,
+    and they check with covers that all their POIs are candidates.
+    """
+    meta_path, matrix_path = _candidate_distances_paths(p, placeid, h3_zoom)
+    graph = json.dumps(graph_source_version(p, placeid, "carall"))
+    try:
+        with np.load(meta_path) as meta:
+            if str(meta["graph"]) != graph:
+                return None
+            if hexes is not None and str(meta["hexes"]) != hexes:
+                return None
+            ids = meta["ids"]
+        matrix = np.load(matrix_path, mmap_mode="r")
+        if matrix.shape != (len(ids), len(ids)):
+            return None
+        return CandidateDistances(G, ids, matrix)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+
+def write_candidate_distances(
+    p: Path, placeid: str, h3_zoom: int, hex_ids, centroids, G_ox, snapthreshold
+):
+    """Snap the centroids of all H3 hexagons hex_ids of placeid at h3_zoom to
+    their nearest carall nodes within snapthreshold meters, as the exemplars
+    are snapped, and store the network distances between all those candidate
+    nodes: the node ids in an npz file and the matrix in an npy file that is
+    read memory-mapped. Nothing is done if they are stored already for the same
+    hexagons and carall files, or there are more than candidate_distances_max
+    candidates. Returns the CandidateDistances, or None.
+    """
+    hexes = hashlib.sha256(
+        json.dumps([sorted(map(str, hex_ids)), snapthreshold]).encode()
+    ).hexdigest()
+    G = csv_to_ig(p, placeid, "carall")
+    candidates = read_candidate_distances(p, placeid, h3_zoom, G, hexes)
+    if candidates is not None:
+        return candidates
+
+    x = np.array([c.x for c in centroids])
+    y = np.array([c.y for c in centroids])
+    nearest = np.asarray(ox.distance.nearest_nodes(G_ox, x, y))
+    nodes = np.array([(G_ox.nodes[n]["y"], G_ox.nodes[n]["x"]) for n in nearest])
+    near = haversine_vector(np.column_stack((y, x)), nodes, unit="m") <= snapthreshold
+    ids = np.unique(nearest[near]).astype(np.int64)
+    if len(ids) > candidate_distances_max:
+        return None
+
+    meta_path, matrix_path = _candidate_distances_paths(p, placeid, h3_zoom)
+    # Written aside and renamed, the npz last as it marks them complete
+    partial = f".{os.getpid()}.{threading.get_ident()}"
+    partial_matrix = matrix_path.with_name(matrix_path.name + partial + ".npy")
+    partial_meta = meta_path.with_name(meta_path.name + partial + ".npz")
+    indices = np.asarray(vertex_indices(G, ids.tolist()), dtype=np.int64)
+    matrix = np.lib.format.open_memmap(
+        partial_matrix, mode="w+", dtype=np.float64, shape=(len(ids), len(ids))
+    )
+    # One pool for all chunks of rows, which are written as they come
+    chunks = np.array_split(np.arange(len(ids)), max(1, len(ids) // 256))
+    sources = [indices[rows].tolist() for rows in chunks]
+    for rows, block in zip(chunks, distance_chunks(G, sources, indices.tolist())):
+        matrix[rows] = block
+    matrix.flush()
+    del matrix
+    os.replace(partial_matrix, matrix_path)
+    np.savez(
+        partial_meta,
+        ids=ids,
+        graph=np.array(json.dumps(graph_source_version(p, placeid, "carall"))),
+        hexes=np.array(hexes),
+    )
+    os.replace(partial_meta, meta_path)
+    return read_candidate_distances(p, placeid, h3_zoom, G, hexes)
+
+
+def poipair_arrays(G, G_carall, pois, contracted=None):
     """Calculates the (weighted) graph distances on G for a subset of nodes pois.
-    Returns all pairs of poi ids in ascending order of their distance.
-    If return_distances, then distances are also returned.
+    Returns the arrays (sources, targets, distances) of all connected pairs of
+    distinct pois as vertex indices of G, in ascending order of distance.
+    Distances come from one batched distance_matrix call; no paths are built.
+    With a ContractedGraph of G keeping the pois or a ContractionHierarchy of G,
+    they are computed on it, and with CandidateDistances covering the pois they
+    are read from it.
     """
 
     if not isinstance(pois, (list, set, tuple)):
@@ -1222,35 +2760,55 @@ def poipairs_by_distance(G, G_carall, pois, return_distances=False):
         )
 
     # Get poi indices
-    indices = []
-    for poi in pois:
-        indices.append(G_carall.vs.find(id=poi).index)
-
-    # Get sequences of nodes and edges in shortest paths between all pairs of pois
-    poi_nodes = []
-    poi_edges = []
-    for c, v in enumerate(indices):
-        poi_nodes.append(
-            G.get_shortest_paths(v, indices[c:], weights="weight", output="vpath")
-        )
-        poi_edges.append(
-            G.get_shortest_paths(v, indices[c:], weights="weight", output="epath")
+    indices = vertex_indices(G_carall, pois)
+    if not indices:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64)
+
+    # Distances between all pairs of pois, each pair once in the order of pois
+    unique, position = np.unique(indices, return_inverse=True)
+    if contracted is not None:
+        dist = contracted.distance_matrix(unique.tolist(), unique.tolist())
+    else:
+        dist = distance_matrix(G, unique.tolist(), unique.tolist())
+    dist = dist[np.ix_(position, position)]
+    rows, cols = np.triu_indices(len(indices))
+    dist = dist[rows, cols]
+    keep = np.isfinite(dist) & (dist > 0)
+    sources = np.asarray(indices)[rows[keep]]
+    targets = np.asarray(indices)[cols[keep]]
+    dist = dist[keep]
+    if len(set(indices)) < len(indices):
+        # Repeated pois give repeated pairs, keep the first of each
+        _, first = np.unique(
+            np.column_stack((sources, targets)), axis=0, return_index=True
         )
+        first.sort()
+        sources, targets, dist = sources[first], targets[first], dist[first]
+
+    # Ascending distance, ties in pair order
+    order = np.argsort(dist, kind="stable")
+    return sources[order], targets[order], dist[order]
+
+
+def poipairs_by_distance(G, G_carall, pois, return_distances=False):
+    """Calculates the (weighted) graph distances on G for a subset of nodes pois.
+    Returns all pairs of poi ids in ascending order of their distance.
+    If return_distances, then distances are also returned.
+    See poipair_arrays.
+    """
+    return poipairs_from_arrays(
+        G, *poipair_arrays(G, G_carall, pois), return_distances=return_distances
+    )
 
-    # Sum up weights (distances) of all paths
-    poi_dist = {}
-    for paths_n, paths_e in zip(poi_nodes, poi_edges):
-        for path_n, path_e in zip(paths_n, paths_e):
-            # Sum up distances of path segments from first to last node
-            path_dist = sum([G.es[e]["weight"] for e in path_e])
-            if path_dist > 0:
-                poi_dist[(path_n[0], path_n[-1])] = path_dist
-
-    temp = sorted(poi_dist.items(), key=lambda x: x[1])
-    # Back to ids
-    output = []
-    for p in temp:
-        output.append([(G.vs[p[0][0]]["id"], G.vs[p[0][1]]["id"]), p[1]])
+
+def poipairs_from_arrays(G, sources, targets, dist, return_distances=False):
+    """The poipairs_by_distance list of the arrays of poipair_arrays."""
+    ids = G.vs["id"]
+    output = [
+        [(ids[source], ids[target]), d]
+        for source, target, d in zip(sources.tolist(), targets.tolist(), dist.tolist())
+    ]
 
     if return_distances:
         return output
@@ -1258,6 +2816,42 @@ def poipairs_by_distance(G, G_carall, pois, return_distances=False):
         return [o[0] for o in output]
 
 
+def write_poi_distances(path, G, pois, arrays):
+    """Write the arrays of poipair_arrays(G, ..., pois) to the npz file path,
+    with the pairs as vertex ids so they survive reloading G.
+    """
+    sources, targets, dist = arrays
+    ids = np.asarray(G.vs["id"])
+    np.savez(
+        path,
+        pois=np.asarray(pois),
+        sources=ids[sources],
+        targets=ids[targets],
+        distances=dist,
+    )
+
+
+def read_poi_distances(path, G, pois):
+    """Read the arrays written by write_poi_distances as vertex indices of G.
+    Returns None if there is no file, it was written for other pois or G
+    lacks some of its vertices.
+    """
+    try:
+        with np.load(path) as data:
+            if not np.array_equal(data["pois"], np.asarray(pois)):
+                return None
+            ends, inverse = np.unique(
+                np.concatenate((data["sources"], data["targets"])),
+                return_inverse=True,
+            )
+            dist = data["distances"]
+        ends = np.asarray(vertex_indices(G, ends.tolist()), dtype=np.int64)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    sources, targets = np.split(ends[inverse], 2)
+    return sources, targets, dist
+
+
 # ANALYSIS
 
 
@@ -1460,9 +3054,7 @@ def calculate_coverage_edges(
 def calculate_poiscovered(G, cov, nnids):
     """Calculates how many nodes, given by nnids, are covered by the shapely (multi)polygon cov"""
 
-    pois_indices = set()
-    for poi in nnids:
-        pois_indices.add(G.vs.find(id=poi).index)
+    pois_indices = set(vertex_indices(G, nnids))
 
     poiscovered = 0
     for poi in pois_indices:
@@ -1699,6 +3291,180 @@ def calculate_metric(
     return result, cov_prev
 
 
+# Vertex and edge attributes the metrics need, with the dtype they are shared as
+SHARED_GRAPH_ATTRIBUTES = {
+    "vs": {"x": np.float64, "y": np.float64, "id": np.int64},
+    "es": {"weight": np.float64},
+}
+
+
+def share_graph(G, blocks, attributes=None):
+    """Place the edge list and the attributes (default SHARED_GRAPH_ATTRIBUTES)
+    of igraph G in shared memory.
+    Returns a small picklable handle for attach_graph. The created SharedMemory
+    blocks are appended to blocks; the caller must close and unlink them.
+    """
+    if G is None:
+        return None
+
+    arrays = {"edges": np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)}
+    for seq, attributes in (attributes or SHARED_GRAPH_ATTRIBUTES).items():
+        names = getattr(G, seq).attribute_names()
+        for name, dtype in attributes.items():
+            if name in names:
+                arrays[f"{seq}_{name}"] = np.asarray(getattr(G, seq)[name], dtype=dtype)
+
+    handle = {"vcount": G.vcount(), "arrays": {}}
+    for key, array in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(shm)
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+        handle["arrays"][key] = (shm.name, array.shape, array.dtype.str)
+    return handle
+
+
+def attach_graph(handle):
+    """Rebuild an igraph graph from a handle made by share_graph, reading its
+    arrays from shared memory instead of unpickling them. This builds a new
+    graph, so worker processes attach once with init_shared_graphs.
+    """
+    if handle is None:
+        return None
+
+    arrays = {}
+    for key, (name, shape, dtype) in handle["arrays"].items():
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            arrays[key] = np.ndarray(shape, dtype, buffer=shm.buf).tolist()
+        finally:
+            shm.close()
+
+    G = ig.Graph(n=handle["vcount"], edges=arrays.pop("edges"), directed=False)
+    for key, values in arrays.items():
+        seq, name = key.split("_", 1)
+        getattr(G, seq)[name] = values
+    return G
+
+
+_shared_graphs = {}  # Graphs attached in this worker process by init_shared_graphs
+
+
+def init_shared_graphs(handles):
+    """ProcessPoolExecutor initializer attaching the share_graph handles, a dict
+    name -> handle, once per worker process. Jobs get them with shared_graph.
+    """
+    _shared_graphs.clear()
+    for name, handle in handles.items():
+        _shared_graphs[name] = attach_graph(handle)
+
+
+def shared_graph(name):
+    """Copy of the graph attached as name by init_shared_graphs, None for None."""
+    G = _shared_graphs.get(name)
+    return None if G is None else G.copy()
+
+
+def _distance_rows(sources, targets):
+    """Distances from sources to targets on the graph attached as "G"."""
+    G = _shared_graphs["G"]
+    return np.array(
+        G.distances(source=sources, target=targets, weights="weight"),
+        dtype=np.float64,
+    ).reshape(len(sources), len(targets))
+
+
+def distance_matrix(G, sources, targets, workers=None) -> np.ndarray:
+    """Matrix of the weighted shortest path distances on G from the vertex
+    indices sources (rows) to the distinct vertex indices targets (columns),
+    inf where there is no path.
+    With distance_parallel_min_sources or more sources the sources are split
+    across a pool of workers processes (default distance_workers, 0 for all
+    cores) that attach G from shared memory once; smaller inputs run serially.
+    """
+    sources, targets = list(sources), list(targets)
+    if not sources or not targets:
+        return np.full((len(sources), len(targets)), np.inf)
+
+    if workers is None:
+        workers = distance_workers
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    chunks = [chunk.tolist() for chunk in np.array_split(sources, max(1, workers))]
+    return np.vstack(list(distance_chunks(G, chunks, targets, workers)))
+
+
+def distance_chunks(G, chunks, targets, workers=None):
+    """Yield the distance_matrix of each list of vertex indices in chunks to
+    targets, in order. With distance_parallel_min_sources or more sources in
+    all they are computed by one pool of workers processes (default
+    distance_workers, 0 for all cores) that attach G from shared memory once.
+    """
+    if workers is None:
+        workers = distance_workers
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1 or sum(map(len, chunks)) < distance_parallel_min_sources:
+        for sources in chunks:
+            yield np.array(
+                G.distances(source=sources, target=targets, weights="weight"),
+                dtype=np.float64,
+            ).reshape(len(sources), len(targets))
+        return
+
+    blocks = []
+    try:
+        handles = {"G": share_graph(G, blocks)}
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_shared_graphs,
+            initargs=(handles,),
+        ) as executor:
+            yield from executor.map(_distance_rows, chunks, [targets] * len(chunks))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def calculate_metric_shared(
+    metric,
+    G,
+    GT_abstract,
+    G_big,
+    nnids,
+    G_prev,
+    cov_prev,
+    buffer_walk,
+    numnodepairs,
+    verbose,
+    return_cov,
+    Gexisting,
+    *args,
+):
+    """Call calculate_metric on graphs attached by init_shared_graphs, given
+    by their names (Gexisting as a dict key -> name). Takes the arguments of
+    calculate_metric except cl, which is computed here. Each job works on
+    copies, so the attached graphs are reused by the next jobs of the worker.
+    """
+    G = shared_graph(G)
+    if Gexisting is not None:
+        Gexisting = {key: shared_graph(name) for key, name in Gexisting.items()}
+    return calculate_metric(
+        metric,
+        G,
+        shared_graph(GT_abstract),
+        shared_graph(G_big),
+        nnids,
+        G.connected_components(),
+        shared_graph(G_prev),
+        cov_prev,
+        buffer_walk,
+        numnodepairs,
+        verbose,
+        return_cov,
+        Gexisting,
+        *args,
+    )
+
+
 def calculate_metrics_parallel(
     G,
     GT_abstract,
@@ -1714,44 +3480,64 @@ def calculate_metrics_parallel(
     ignore_GT_abstract=False,
     Gexisting=None,
 ):
-    """Calculates all metrics in parallel."""
+    """Calculates all metrics in parallel.
+    The graphs are placed once in shared memory instead of being pickled for every
+    metric, and each worker process attaches them once.
+    """
 
     output = {key: 0 for key in calcmetrics}
 
     manager = Manager()
     cov = manager.dict()
 
-    cl = G.clusters()
-
-    with ProcessPoolExecutor() as executor:
-        futures = {
-            metric: executor.submit(
-                calculate_metric,
-                metric,
-                G,
-                GT_abstract,
-                G_big,
-                nnids,
-                cl,
-                G_prev,
-                cov_prev,
-                buffer_walk,
-                numnodepairs,
-                verbose,
-                return_cov,
-                Gexisting,
-                ignore_GT_abstract,
-            )
-            for metric in calcmetrics
+    blocks = []
+    try:
+        handles = {
+            "G": share_graph(G, blocks),
+            "GT_abstract": share_graph(GT_abstract, blocks),
+            "G_big": share_graph(G_big, blocks),
+            "G_prev": share_graph(G_prev, blocks),
         }
+        Gexisting_names = None
+        if Gexisting is not None:
+            Gexisting_names = {key: f"Gexisting_{key}" for key in Gexisting}
+            for key, graph in Gexisting.items():
+                handles[Gexisting_names[key]] = share_graph(graph, blocks)
+
+        with ProcessPoolExecutor(
+            initializer=init_shared_graphs, initargs=(handles,)
+        ) as executor:
+            futures = {
+                metric: executor.submit(
+                    calculate_metric_shared,
+                    metric,
+                    "G",
+                    "GT_abstract",
+                    "G_big",
+                    nnids,
+                    "G_prev",
+                    cov_prev,
+                    buffer_walk,
+                    numnodepairs,
+                    verbose,
+                    return_cov,
+                    Gexisting_names,
+                    ignore_GT_abstract,
+                )
+                for metric in calcmetrics
+            }
 
-        for metric, future in futures.items():
-            try:
-                result, cov_result = future.result()
-                output.update(result)  # Merge results
-                cov.update(cov_result)  # Merge coverage results
-            except Exception as e:
-                logging.error(f"Error calculating {metric}: {e}")
+            for metric, future in futures.items():
+                try:
+                    result, cov_result = future.result()
+                    output.update(result)  # Merge results
+                    cov.update(cov_result)  # Merge coverage results
+                except Exception as e:
+                    logging.error(f"Error calculating {metric}: {e}")
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
 
     logging.info(output)
 
@@ -1787,8 +3573,8 @@ def intersect_igraphs(G1, G2):
         n1_id = e.source_vertex["id"]
         n2_id = e.target_vertex["id"]
         try:
-            n1_index = G2.vs.find(id=n1_id).index
-            n2_index = G2.vs.find(id=n2_id).index
+            n1_index = vertex_index(G2, n1_id)
+            n2_index = vertex_index(G2, n2_id)
         except ValueError:
             continue
         if G2.are_connected(n1_index, n2_index):
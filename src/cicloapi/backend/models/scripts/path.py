@@ -17,6 +17,7 @@ PATH = {
     "exports_json": BASE_DIR / "bikenwgrowth_external" / "exports_json",
     "logs": BASE_DIR / "bikenwgrowth_external" / "logs",
     "task_output": API_DIR / "data" / "endpoints",
+    "result_cache": API_DIR / "data" / "result_cache",
 }
 
 for path in PATH.values():
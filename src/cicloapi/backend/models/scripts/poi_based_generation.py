@@ -5,25 +5,48 @@ debug = False
 
 # system
 import logging
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 # Local
 from cicloapi.backend.models.scripts.functions import (
     csv_to_ig,
+    ContractedGraph,
+    contraction_hierarchy,
+    graph_source_version,
+    result_cache,
     write_result,
     mst_routing,
     greedy_triangulation_routing,
-    ig_to_geojson
+    new_edge_wkts,
+    PathCache,
+    poipair_arrays,
+    read_candidate_distances,
+    read_poi_distances,
+    write_poi_distances,
+    vertex_indices,
+    SHARED_GRAPH_ATTRIBUTES,
+    share_graph,
+    init_shared_graphs,
+    shared_graph,
+)
+from cicloapi.backend.models.parameters.parameters import (
+    poi_source,
+    prune_quantiles,
+    connectivity_parallel,
+    gt_candidates,
+    gt_candidates_k,
+    gt_candidates_verify,
+    routing_graph,
 )
-from cicloapi.backend.models.parameters.parameters import poi_source, prune_quantiles
 from cicloapi.database.db_methods import Database
 from cicloapi.database.database_models import SessionLocal
 
 from pathlib import Path
 from typing import Dict, Union
 import igraph as ig
-from shapely.geometry import shape, mapping
-
-from shapely.geometry import LineString
+import numpy as np
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -36,13 +59,78 @@ logger.addHandler(console_handler)
 logger = logging.getLogger("uvicorn.error")
 
 
+def route_connectivity(
+    family: str,
+    G_carall: ig.Graph,
+    nnids: list,
+    distances,
+    prune_measure: str,
+    path_cache: PathCache = None,
+    contracted: ContractedGraph = None,
+) -> dict:
+    """
+    Route one connectivity family ("GTs" or "MST") between the POIs nnids,
+    given their poipair_arrays distances. Returns its entries of the results.
+    Without a path_cache, the paths are routed on contracted (a ContractedGraph
+    or ContractionHierarchy of G_carall) if given.
+    """
+    path_cache = path_cache or PathCache(G_carall, contracted=contracted)
+    if family == "GTs":
+        GTs, GT_abstracts = greedy_triangulation_routing(
+            G_carall,
+            G_carall,
+            nnids,
+            prune_quantiles,
+            prune_measure,
+            path_cache,
+            distances,
+        )
+        return {"GTs": GTs, "GT_abstracts": GT_abstracts}
+    MST, MST_abstract = mst_routing(G_carall, G_carall, nnids, path_cache, distances)
+    return {"MST": MST, "MST_abstract": MST_abstract}
+
+
+# The carall attributes kept in routed results, shared with the MST process
+CARALL_ATTRIBUTES = {
+    **SHARED_GRAPH_ATTRIBUTES,
+    "es": {"weight": np.float64, "osmid": np.int64},
+}
+
+
+def route_connectivity_shared(
+    family: str,
+    nnids: list,
+    distances,
+    prune_measure: str,
+    routing: str,
+    p: Path,
+    placeid: str,
+) -> dict:
+    """
+    route_connectivity on the carall graph attached as "G_carall" by
+    init_shared_graphs. Its routing graph (see routing_graph) is rebuilt here,
+    the contraction hierarchy read from the file next to the graph files of placeid.
+    """
+    G_carall = shared_graph("G_carall")
+    contracted = None
+    if routing == "contracted":
+        contracted = ContractedGraph(G_carall, vertex_indices(G_carall, nnids))
+    elif routing == "ch":
+        contracted = contraction_hierarchy(p, placeid, "carall", G_carall)
+    return route_connectivity(
+        family, G_carall, nnids, distances, prune_measure, contracted=contracted
+    )
+
+
 def main(
     PATH: str,
     task_id: str,
     cities: Dict[str, Dict[str, Union[str, None]]],
     prune_measure: str = "betweenness",
     connectivity: str = "GTs", # GTs or MST
-
+    connectivity_only: bool = False,
+    reuse: bool = False,
+    h3_zoom: int = None,
 ) -> None:
     """
     Generate bikelane networks for multiple cities and perform routing analysis.
@@ -51,6 +139,14 @@ def main(
         PATH (Dict[str, Path]): Dictionary containing paths to data and output directories.
         task_id (str): Identifier for the current task.
         cities (Dict[str, Dict[str, str]]): Dictionary where keys are place IDs and values contain city metadata.
+        connectivity_only (bool): Compute only the connectivity family instead of both GTs and MST.
+        reuse (bool): Add the connectivity family to the results of the earlier run task_id,
+            from its cached POI distances, keeping the families computed then.
+        h3_zoom (int): H3 zoom of the POIs, to read their distances from the stored
+            distances of all H3 candidates of the city (see write_candidate_distances).
+
+    Results are copied from the result cache when an earlier run had the same
+    city graph, POIs and prune settings, except for random pruning.
 
     Returns:
         None
@@ -66,38 +162,148 @@ def main(
     
     for placeid, placeinfo in cities.items():
         logger.info(f"{placeid}: Generating networks")
-
-        # Load transportation network
-        G_carall = csv_to_ig(PATH["data"] / placeid, placeid, "carall")
+        task_path = Path(PATH["task_output"]) / task_id
 
         # Load network nodes
-        nnids_path = (
-            Path(PATH["task_output"]) / task_id / f"{placeid}_nnids_sliders.csv"
-        )
+        nnids_path = task_path / f"{placeid}_nnids_sliders.csv"
         with nnids_path.open() as f:
             nnids = [int(line.rstrip()) for line in f]
+        families = [connectivity] if connectivity_only or reuse else ["GTs", "MST"]
 
-        # Generate routing results
-        logger.info(f"{placeid}: Running greedy triangulation routing")
-        GTs, GT_abstracts = greedy_triangulation_routing(
-            G_carall, G_carall, nnids, prune_quantiles, prune_measure
-        )
+        # Copy the results of an earlier run with the same inputs
+        cache_key = None
+        if not reuse and prune_measure != "random":
+            cache_key = result_cache.key(
+                placeid=placeid,
+                graph=graph_source_version(PATH["data"] / placeid, placeid, "carall"),
+                nnids=nnids,
+                poi_source=poi_source,
+                prune_measure=prune_measure,
+                prune_quantiles=prune_quantiles,
+                connectivity=connectivity,
+                families=families,
+                gt_candidates=[gt_candidates, gt_candidates_k, gt_candidates_verify],
+                routing_graph=routing_graph,
+            )
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                entry, segments_data = cached
+                logger.info(f"{placeid}: Copying cached results")
+                for file in entry.iterdir():
+                    if file.name != result_cache.segments_name:
+                        shutil.copyfile(file, task_path / file.name)
+                for row in segments_data:
+                    row["task_id"] = task_id
+                Database.insert_simulation_segments(database, segments_data)
+                continue
 
-        logger.info(f"{placeid}: Running MST routing")
-        MST, MST_abstract = mst_routing(G_carall, G_carall, nnids)
+        # Load transportation network
+        G_carall = csv_to_ig(PATH["data"] / placeid, placeid, "carall")
+        contracted = None
+        if routing_graph == "contracted":
+            contracted = ContractedGraph(G_carall, vertex_indices(G_carall, nnids))
+            logger.info(
+                f"{placeid}: Routing on {contracted.H.vcount()} of "
+                f"{G_carall.vcount()} nodes"
+            )
+        elif routing_graph == "ch":
+            contracted = contraction_hierarchy(
+                PATH["data"] / placeid, placeid, "carall", G_carall
+            )
+
+        # POI distances, cached for later runs of the same task
+        distances_path = task_path / f"{placeid}_poi_distances.npz"
+        distances = read_poi_distances(distances_path, G_carall, nnids)
+        if distances is None:
+            candidates = None
+            if h3_zoom is not None:
+                candidates = read_candidate_distances(
+                    PATH["data"] / placeid, placeid, h3_zoom, G_carall
+                )
+            if candidates is not None and candidates.covers(
+                vertex_indices(G_carall, nnids)
+            ):
+                logger.info(f"{placeid}: Reading POI distances of the H3 candidates")
+                distances = poipair_arrays(G_carall, G_carall, nnids, candidates)
+            else:
+                logger.info(f"{placeid}: Computing POI distances")
+                distances = poipair_arrays(G_carall, G_carall, nnids, contracted)
+            write_poi_distances(distances_path, G_carall, nnids, distances)
+
+        # Generate routing results
+        logger.info(f"{placeid}: Running {' and '.join(families)} routing")
+        routed = {}
+        if len(families) > 1 and connectivity_parallel:
+            # The MST is routed in a second process while this one routes the
+            # GTs. The process attaches the carall graph from shared memory.
+            # The processes do not share paths, so MST paths that are also
+            # GT paths are routed twice; connectivity_parallel = False routes
+            # each path once, in one process.
+            blocks = []
+            try:
+                handles = {
+                    "G_carall": share_graph(G_carall, blocks, CARALL_ATTRIBUTES)
+                }
+                with ProcessPoolExecutor(
+                    max_workers=1,
+                    initializer=init_shared_graphs,
+                    initargs=(handles,),
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            route_connectivity_shared,
+                            family,
+                            nnids,
+                            distances,
+                            prune_measure,
+                            routing_graph,
+                            PATH["data"] / placeid,
+                            placeid,
+                        )
+                        for family in families[1:]
+                    ]
+                    routed.update(
+                        route_connectivity(
+                            families[0],
+                            G_carall,
+                            nnids,
+                            distances,
+                            prune_measure,
+                            contracted=contracted,
+                        )
+                    )
+                    for future in futures:
+                        routed.update(future.result())
+            finally:
+                for shm in blocks:
+                    shm.close()
+                    shm.unlink()
+        else:
+            # In one process the MST reuses the paths routed for the GTs
+            path_cache = PathCache(G_carall, contracted=contracted)
+            for family in families:
+                routed.update(
+                    route_connectivity(
+                        family, G_carall, nnids, distances, prune_measure, path_cache
+                    )
+                )
 
         # Store results (new key "connectivity" added)
-        results = {
-            "placeid": placeid,
-            "prune_measure": prune_measure,
-            "poi_source": poi_source,
-            "prune_quantiles": prune_quantiles,
-            "connectivity_res": connectivity,
-            "GTs": GTs,
-            "GT_abstracts": GT_abstracts,
-            "MST": MST,
-            "MST_abstract": MST_abstract,
-        }
+        results = {}
+        result_path = task_path / f"{placeid}_{prune_measure}.pickle"
+        if reuse and result_path.exists():
+            with result_path.open("rb") as f:
+                results = pickle.load(f)
+        results.update(
+            {
+                "placeid": placeid,
+                "prune_measure": prune_measure,
+                "poi_source": poi_source,
+                "prune_quantiles": prune_quantiles,
+                "connectivity_res": connectivity,
+            }
+        )
+        results.update(routed)
 
         path_output = PATH["task_output"]
         logger.info(f"{placeid}: Writing results to geojson and pickle")
@@ -108,126 +314,44 @@ def main(
             path_output, task_id, results, "geojson", placeid, prune_measure, ".geojson"
         )
         
-        # Convert results into Database format
-        logger.info("Starting conversion of results to geojson format...")
-        geojson_data = {}
-        for key, val in results.items():
-            if isinstance(val, list) and all(isinstance(item, ig.Graph) for item in val):
-                new_geoms = []
-                previous_geom = None
-                for idx, (q, item) in enumerate(zip(results["prune_quantiles"], val)):
-                    logger.info(f"  Processing list item at index {idx} with quantile {q}")
-                    current_geom_shapely = shape(ig_to_geojson(item))
-
-                    if idx == 0:
-                        if current_geom_shapely.geom_type == "GeometryCollection":
-                            
-                            for seg_id, seg in enumerate(current_geom_shapely.geoms):
-                                new_geoms.append({
-                                    "prune_index": idx,
-                                    "quantile": q,
-                                    "segment_id": seg_id,
-                                    "linestring": mapping(seg),
-                                })
-                        elif current_geom_shapely.geom_type == "LineString":
-                            new_geoms.append({
-                                "prune_index": idx,
-                                "quantile": q,
-                                "segment_id": 0,
-                                "linestring": mapping(current_geom_shapely),
-                            })
-                        else:
-                            new_geoms.append({
-                                "prune_index": idx,
-                                "quantile": q,
-                                "geometry": mapping(current_geom_shapely),
-                            })
-                        previous_geom = current_geom_shapely
-                        continue
-                    if previous_geom is not None:
-                        diff_geom = current_geom_shapely.difference(previous_geom)
-                    else:
-                        diff_geom = current_geom_shapely
-                    previous_geom = current_geom_shapely
-                    
-                    # Create segments with segment_id and linestring
-                    if diff_geom.geom_type == "MultiLineString":
-                        segments = []
-                        for seg_id, seg in enumerate(diff_geom.geoms):
-                            segments.append({
-                                "segment_id": seg_id,
-                                "linestring": mapping(seg),
-                            })
-                        new_geoms.append({
-                            "prune_index": idx,
-                            "quantile": q,
-                            "segments": segments,
-                        })
-                    elif diff_geom.geom_type == "LineString":
-                        new_geoms.append({
-                            "prune_index": idx,
-                            "quantile": q,
-                            "segment_id": 0,
-                            "linestring": mapping(diff_geom),
-                        })
-                    else:
-                        # Fallback: store the whole geometry
-                        new_geoms.append({
-                            "prune_index": idx,
-                            "quantile": q,
-                            "geometry": mapping(diff_geom),
-                        })
-                geojson_data[key] = new_geoms
-            elif isinstance(val, ig.Graph):
-                
-                geojson_data[key] = {"geometry": ig_to_geojson(val)}
-            else:
-                geojson_data[key] = val
-                
-        logger.info("Completed geojson conversion:")
-
+        # Convert results into Database format: the GTs of consecutive quantiles
+        # are nested, so each quantile only adds the edges missing from the previous
+        logger.info("Starting conversion of results to WKT segments...")
         segments_data = []
-        for key, geoms in geojson_data.items():
-
-            if isinstance(geoms, list) and key in [connectivity]:
-                for item in geoms:
-
-                    if "segments" in item:
-                        for seg in item["segments"]:
-                            wkt_geom = shape(seg["linestring"]).wkt
-                            segments_data.append({
-                                "task_id": task_id,
-                                "city_id": placeid,
-                                "connectivity": connectivity,
-                                "prune_index": item["prune_index"],
-                                "quantile": item["quantile"],
-                                "geometry": wkt_geom,
-                            })
-                    elif "linestring" in item:
-                        wkt_geom = shape(item["linestring"]).wkt
-                        segments_data.append({
-                            "task_id": task_id,
-                            "city_id": placeid,
-                            "connectivity": connectivity,
-                            "prune_index": item["prune_index"],
-                            "quantile": item["quantile"],
-                            "geometry": wkt_geom,
-                        })
-                    elif "geometry" in item:
-                        wkt_geom = shape(item["geometry"]).wkt
-                        segments_data.append({
-                            "task_id": task_id,
-                            "city_id": placeid,
-                            "connectivity": connectivity,
-                            "prune_index": item["prune_index"],
-                            "quantile": item["quantile"],
-                            "geometry": wkt_geom,
-                        })
-                    else:
-                        logger.error("No geometry found in item")
+        val = results.get(connectivity)
+        quantiles = results["prune_quantiles"]
+        if isinstance(val, ig.Graph):
+            val, quantiles = [val], [1]  # The MST is not pruned
+        if isinstance(val, list) and all(isinstance(item, ig.Graph) for item in val):
+            for idx, (q, wkts) in enumerate(zip(quantiles, new_edge_wkts(val))):
+                logger.info(f"  Quantile {q} (index {idx}): {len(wkts)} new segments")
+                segments_data.extend(
+                    {
+                        "task_id": task_id,
+                        "city_id": placeid,
+                        "connectivity": connectivity,
+                        "prune_index": idx,
+                        "quantile": q,
+                        "geometry": wkt,
+                    }
+                    for wkt in wkts
+                )
+        logger.info("Completed WKT conversion")
+
         # insert segments_data into the database
         Database.insert_simulation_segments(database, segments_data)
-            
+
+        if cache_key is not None:
+            result_cache.put(
+                cache_key,
+                [
+                    result_path,
+                    task_path / f"{placeid}_{prune_measure}.geojson",
+                    distances_path,
+                ],
+                segments_data,
+            )
+
 
 if __name__ == "__main__":
     main()
@@ -32,9 +32,18 @@ from cicloapi.backend.models.scripts.functions import (
     fill_holes,
     extract_relevant_polygon,
     ox_to_csv,
-    compress_file,
+    check_compression_codec,
+    compress_files,
+    contraction_hierarchy,
+    write_city_bundle,
+)
+from cicloapi.backend.models.parameters.parameters import (
+    networktypes,
+    osmnxparameters,
+    compression_codec,
+    compression_workers,
+    routing_graph,
 )
-from cicloapi.backend.models.parameters.parameters import networktypes, osmnxparameters
 
 # Configuración del logger
 logging.basicConfig(
@@ -45,8 +54,11 @@ logger = logging.getLogger("uvicorn.error")
 
 
 def main(PATH, cities):
+    # Fail before downloading anything if the codec's package is missing
+    check_compression_codec(compression_codec)
     logger.info("Starting network processing...")
     logger.info(cities.items())
+    written = []  # CSVs written by this run, compressed at the end
     for placeid, placeinfo in tqdm(cities.items(), desc="Cities"):
         logger.info(f"Processing city: {placeid}")
 
@@ -86,6 +98,7 @@ def main(PATH, cities):
                 continue
 
         Gs = {}
+        bundle = {}  # Arrays of all network variants, see write_city_bundle
         for parameterid, parameterinfo in tqdm(
             osmnxparameters.items(), desc="Networks", leave=False
         ):
@@ -119,7 +132,14 @@ def main(PATH, cities):
                     continue
 
             if parameterinfo["export"]:
-                ox_to_csv(Gs[parameterid], PATH["data"] / placeid, placeid, parameterid)
+                written += ox_to_csv(
+                    Gs[parameterid],
+                    PATH["data"] / placeid,
+                    placeid,
+                    parameterid,
+                    compress=False,
+                    bundle=bundle,
+                )
 
         # Composing special cases
         try:
@@ -134,19 +154,35 @@ def main(PATH, cities):
                     Gs["bike_cyclestreet"],
                 ]
             )
-            ox_to_csv(Gs["biketrack"], PATH["data"] / placeid, placeid, "biketrack")
+            written += ox_to_csv(
+                Gs["biketrack"],
+                PATH["data"] / placeid,
+                placeid,
+                "biketrack",
+                compress=False,
+                bundle=bundle,
+            )
 
             Gs["bikeable"] = nx.compose_all(
                 [Gs["biketrack"], Gs["car30"], Gs["bike_livingstreet"]]
             )
-            ox_to_csv(Gs["bikeable"], PATH["data"] / placeid, placeid, "bikeable")
+            written += ox_to_csv(
+                Gs["bikeable"],
+                PATH["data"] / placeid,
+                placeid,
+                "bikeable",
+                compress=False,
+                bundle=bundle,
+            )
 
             Gs["biketrackcarall"] = nx.compose(Gs["biketrack"], Gs["carall"])
-            ox_to_csv(
+            written += ox_to_csv(
                 Gs["biketrackcarall"],
                 PATH["data"] / placeid,
                 placeid,
                 "biketrackcarall",
+                compress=False,
+                bundle=bundle,
             )
         except KeyError as e:
             logger.error(f"Missing key during network composition for {placeid}: {e}")
@@ -156,24 +192,36 @@ def main(PATH, cities):
         # Simplify and save graphs
         for parameterid in networktypes[:-2]:
             try:
-                ox_to_csv(
+                written += ox_to_csv(
                     ox.simplify_graph(Gs[parameterid]),
                     PATH["data"] / placeid,
                     placeid,
                     parameterid,
                     "_simplified",
+                    compress=False,
+                    bundle=bundle,
                 )
             except Exception as e:
                 logger.error(f"Error simplifying {parameterid} for {placeid}: {e}")
 
-    # Compress all data files
-    for folder, _, files in os.walk(PATH["data"]):
-        for file in files:
-            if file.endswith("es.csv"):
-                try:
-                    compress_file(folder, file.split(".")[0])
-                except Exception as e:
-                    logger.error(f"Error compressing {file} in {folder}: {e}")
+        try:
+            write_city_bundle(PATH["data"] / placeid, placeid, bundle)
+        except Exception as e:
+            logger.error(f"Error writing graph bundle for {placeid}: {e}")
+
+    # Compress the data files written by this run
+    errors = compress_files(written, compression_codec, compression_workers)
+    for file, e in errors.items():
+        logger.error(f"Error compressing {file.name} in {file.parent}: {e}")
+
+    # Routing index of the final carall files, see contraction_hierarchy
+    if routing_graph == "ch":
+        for placeid in cities:
+            logger.info(f"Building contraction hierarchy for {placeid}")
+            try:
+                contraction_hierarchy(PATH["data"] / placeid, placeid, "carall")
+            except Exception as e:
+                logger.error(f"Error building contraction hierarchy for {placeid}: {e}")
 
     logger.info("Processing completed!")
 
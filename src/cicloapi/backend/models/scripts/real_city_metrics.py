@@ -19,7 +19,7 @@ from shapely.geometry import Polygon
 
 # Local
 from cicloapi.backend.models.scripts.functions import (
-    csv_to_ig,
+    load_city_bundle,
     calculate_metrics_parallel,
     delete_overlaps,
     intersect_igraphs,
@@ -99,17 +99,19 @@ def main(
             }
 
             # Analyze all networks
-            Gs = {}
+            Gs = load_city_bundle(
+                PATH["data"] / placeid,
+                placeid,
+                [
+                    networktype + postfix
+                    for networktype in networktypes
+                    if networktype not in ["biketrack_onstreet", "bikeable_offstreet"]
+                    for postfix in ["", "_simplified"]
+                ],
+            )
             for networktype in networktypes:
                 logger.info(f"{placeid}: Processing network type: {networktype}")
-                if networktype not in ["biketrack_onstreet", "bikeable_offstreet"]:
-                    Gs[networktype] = csv_to_ig(
-                        PATH["data"] / placeid, placeid, networktype
-                    )
-                    Gs[networktype + "_simplified"] = csv_to_ig(
-                        PATH["data"] / placeid, placeid, networktype + "_simplified"
-                    )
-                elif networktype == "biketrack_onstreet":
+                if networktype == "biketrack_onstreet":
                     Gs[networktype] = intersect_igraphs(Gs["biketrack"], Gs["carall"])
                     Gs[networktype + "_simplified"] = intersect_igraphs(
                         Gs["biketrack_simplified"], Gs["carall_simplified"]
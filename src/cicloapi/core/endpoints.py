@@ -28,6 +28,7 @@ from cicloapi.backend.models.scripts import (
     analyze_results,
     real_city_metrics,
 )
+from cicloapi.backend.models.scripts.functions import graph_cache, result_cache
 from cicloapi.backend.models.parameters.parameters import snapthreshold
 from cicloapi.database.db_methods import Database
 from cicloapi.database.database_models import SessionLocal
@@ -128,7 +129,14 @@ async def city_setup(input: schemas.InputCity):
 async def run_model(input: schemas.InputData):
     """
     Starts execution of a model task.
+    With connectivity_only, only the requested connectivity (GTs or MST) is computed.
+    With the task_id of an earlier, finished run, its POIs and cached
+    distances are reused to add the requested connectivity to its results, without
+    clustering or recomputing the rest.
     """
+    if input.task_id is not None:
+        return await extend_model(input)
+
     task_id = str(uuid.uuid4())  # Generate a unique ID for the task
     logger.info(f"Starting run with task ID: {task_id}")
 
@@ -172,7 +180,16 @@ async def run_model(input: schemas.InputData):
                 sliders["transporte"],
             )
 
-            await asyncio.to_thread(poi_based_generation.main, PATH, task_id, input.city, input.prune_measure, input.connectivity)
+            await asyncio.to_thread(
+                poi_based_generation.main,
+                PATH,
+                task_id,
+                input.city,
+                input.prune_measure,
+                input.connectivity,
+                input.connectivity_only,
+                h3_zoom=input.h3_zoom,
+            )
 
             logger.info(f"Run with task ID: {task_id} finished")
             tasks[task_id].status = 'Completed'
@@ -194,6 +211,71 @@ async def run_model(input: schemas.InputData):
     return {"task_id": task_id}
 
 
+async def extend_model(input: schemas.InputData):
+    """
+    Starts a task adding the requested connectivity to the earlier run input.task_id.
+    The run must be in the database, also after a restart, and be finished.
+    """
+    task_id = input.task_id
+    # Only run IDs are used, as they become part of file paths
+    try:
+        valid = str(uuid.UUID(task_id)) == task_id
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        raise HTTPException(status_code=404, detail=f"No run with ID {task_id}")
+    task_ob = tasks.get(task_id)
+    if task_ob is not None and task_ob.task is not None and not task_ob.task.done():
+        raise HTTPException(
+            status_code=409, detail=f"Run with ID {task_id} is still running"
+        )
+    session = SessionLocal()
+    database = Database(session)
+    if Database.get_simulation_task(database, task_id) is None:
+        raise HTTPException(status_code=404, detail=f"No run with ID {task_id}")
+    PATH = path.PATH
+    for placeid in input.city.keys():
+        nnids_path = Path(PATH["task_output"]) / task_id / f"{placeid}_nnids_sliders.csv"
+        if not nnids_path.is_file():
+            raise HTTPException(
+                status_code=404, detail=f"No run with ID {task_id} for {placeid}"
+            )
+    logger.info(f"Adding {input.connectivity} to run with task ID: {task_id}")
+
+    async def model_task(task_id):
+        try:
+            await asyncio.to_thread(
+                poi_based_generation.main,
+                PATH,
+                task_id,
+                input.city,
+                input.prune_measure,
+                input.connectivity,
+                True,
+                True,
+                input.h3_zoom,
+            )
+
+            logger.info(f"Run with task ID: {task_id} finished")
+            tasks[task_id].status = 'Completed'
+        except asyncio.CancelledError:
+            logger.info(f"Run with task ID: {task_id} cancelled")
+            raise  # Propagate the cancellation exception
+
+    time = str(datetime.datetime.now())
+    task = asyncio.create_task(model_task(task_id))
+    task_ob = schemas.PruneTask(
+        task=task,
+        start_time=time,
+        type='Model_task',
+        city=input.city,
+        prune_measure=input.prune_measure
+    )
+    tasks[task_id] = task_ob
+    task.add_done_callback(lambda t: after_task_done(t, task_id))
+    return {"task_id": task_id}
+
+
 #####################
 #####################
 
@@ -331,6 +413,27 @@ async def check_tasks():
     return tasks
 
 
+# Endpoint to monitor the graph cache
+@router.get("/graph_cache", summary="Query the graph cache statistics.")
+async def graph_cache_stats():
+    """
+    Returns hit/miss/eviction/stale counters and memory use of the in-process cache
+    of loaded graphs.
+    """
+
+    return graph_cache.stats()
+
+
+# Endpoint to monitor the result cache
+@router.get("/result_cache", summary="Query the result cache statistics.")
+async def result_cache_stats():
+    """
+    Returns hit/miss counters and disk use of the cache of /run results.
+    """
+
+    return result_cache.stats()
+
+
 #####################
 #####################
 
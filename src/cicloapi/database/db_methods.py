@@ -95,6 +95,12 @@ class Database:
         self.session.commit()
         logger.info(f'Inserted simulation task with id {simulation_data["task_id"]}.')
         return new_task
+
+    def get_simulation_task(self, task_id: str):
+        """
+        Returns the simulation task with id task_id, or None if there is none.
+        """
+        return self.session.query(F_SimulationTasks).filter_by(task_id=task_id).first()
     
     def insert_simulation_segments(self, segments_data: list):
         """
@@ -24,6 +24,8 @@ class InputData(InputCity):
     }
     buffer_walk_distance: int = 500
     connectivity: str = "GTs"
+    connectivity_only: bool = False  # Compute only the requested connectivity
+    task_id: Optional[str] = None  # Add connectivity to this earlier run
 
 
 
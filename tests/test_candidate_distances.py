@@ -0,0 +1,53 @@
+import random
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts import functions
+from cicloapi.backend.models.scripts.functions import (
+    CandidateDistances,
+    distance_chunks,
+    distance_matrix,
+)
+
+
+def random_graph(seed, n=120):
+    rnd = random.Random(seed)
+    G = ig.Graph.Erdos_Renyi(n=n, m=3 * n)
+    G.vs["id"] = [500 + 7 * v for v in range(n)]
+    G.es["weight"] = [rnd.uniform(1, 100) for _ in range(G.ecount())]
+    return G
+
+
+def reference(G, sources, targets):
+    return np.array(G.distances(source=sources, target=targets, weights="weight"))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_chunks_match_distances(monkeypatch, workers):
+    monkeypatch.setattr(functions, "distance_parallel_min_sources", 10)
+    G = random_graph(0)
+    targets = list(range(0, G.vcount(), 3))
+    chunks = [list(range(start, start + 25)) for start in range(0, 100, 25)]
+    blocks = list(distance_chunks(G, chunks, targets, workers))
+    assert len(blocks) == len(chunks)
+    for sources, block in zip(chunks, blocks):
+        assert np.array_equal(block, reference(G, sources, targets))
+    sources = list(range(G.vcount()))
+    assert np.array_equal(
+        distance_matrix(G, sources, targets, workers), reference(G, sources, targets)
+    )
+
+
+def test_candidate_submatrix():
+    G = random_graph(1)
+    indices = list(range(5, G.vcount(), 2))
+    ids = np.array(G.vs[indices]["id"], dtype=np.int64)
+    candidates = CandidateDistances(G, ids, reference(G, indices, indices))
+    assert candidates.covers([5, 7, 9])
+    assert not candidates.covers([5, 6])
+    sources, targets = [9, 5, 41], [7, 41]
+    assert np.array_equal(
+        candidates.distance_matrix(sources, targets), reference(G, sources, targets)
+    )
@@ -0,0 +1,136 @@
+import random
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts.functions import clusterpairs_by_distance
+
+
+def baseline_clusterpairs(G_total, clusters, clusterinfo, full_run):
+    """clusterpairs_by_distance(..., return_distances=True) as it was, node
+    by node with get_shortest_paths, except that the way back may be longer
+    in the last bits than the way out.
+    """
+    cluster_indices = sorted(clusterinfo, key=lambda c: clusterinfo[c]["length"])
+    clusterpairs = []
+    for i, c1 in enumerate(cluster_indices[:-1]):
+        c1_ids = set(clusters[c1].vs["id"])
+        c1_indices = G_total.vs.select(lambda x: x["id"] in c1_ids).indices
+        for c2 in cluster_indices[i + 1 :]:
+            closest_pair = {"i": -1, "j": -1}
+            min_dist = np.inf
+            c2_ids = set(clusters[c2].vs["id"])
+            c2_indices = G_total.vs.select(lambda x: x["id"] in c2_ids).indices
+            if full_run:
+                for a in c1_indices:
+                    sp = G_total.get_shortest_paths(
+                        a, c2_indices, weights="weight", output="epath"
+                    )
+                    if all(not path for path in sp):
+                        break
+                    for path, c2_index in zip(sp, c2_indices):
+                        if len(path) >= 1:
+                            dist_nodes = sum(G_total.es[e]["weight"] for e in path)
+                            if dist_nodes < min_dist:
+                                closest_pair["i"] = G_total.vs[a]["id"]
+                                closest_pair["j"] = G_total.vs[c2_index]["id"]
+                                min_dist = dist_nodes
+            else:
+                a = clusterinfo[c1]["centroid_index"]
+                sp = G_total.get_shortest_paths(
+                    a, c2_indices, weights="weight", output="epath"
+                )
+                if all(not path for path in sp):
+                    break
+                for path, c2_index in zip(sp, c2_indices):
+                    if len(path) >= 1:
+                        dist_nodes = sum(G_total.es[e]["weight"] for e in path)
+                        if dist_nodes < min_dist:
+                            closest_pair["j"] = G_total.vs[c2_index]["id"]
+                            min_dist = dist_nodes
+                b = G_total.vs.find(id=closest_pair["j"]).index
+                sp = G_total.get_shortest_paths(
+                    b, c1_indices, weights="weight", output="epath"
+                )
+                if all(not path for path in sp):
+                    break
+                for path, c1_index in zip(sp, c1_indices):
+                    if len(path) >= 1:
+                        dist_nodes = sum(G_total.es[e]["weight"] for e in path)
+                        if dist_nodes <= min_dist + 1e-9 * max(1.0, min_dist):
+                            closest_pair["i"] = G_total.vs[c1_index]["id"]
+                            min_dist = dist_nodes
+            if closest_pair["i"] != -1 and closest_pair["j"] != -1:
+                clusterpairs.append(
+                    [(c1, c2), (closest_pair["i"], closest_pair["j"]), min_dist]
+                )
+    clusterpairs.sort(key=lambda x: x[-1])
+    return clusterpairs
+
+
+def make_city(seed, n=12, frac=0.3):
+    """Grid street graph with random weights, and its bike clusters: the
+    connected components of a random subset of its edges.
+    """
+    rnd = random.Random(seed)
+    edges = [
+        (i * n + j, (i + di) * n + j + dj)
+        for i in range(n)
+        for j in range(n)
+        for di, dj in [(1, 0), (0, 1)]
+        if i + di < n and j + dj < n and rnd.random() < 0.9
+    ]
+    G_total = ig.Graph(n=n * n, edges=edges)
+    G_total.vs["id"] = [7000 + 3 * v for v in range(n * n)]
+    G_total.vs["x"] = [v // n + rnd.random() * 0.1 for v in range(n * n)]
+    G_total.vs["y"] = [v % n + rnd.random() * 0.1 for v in range(n * n)]
+    G_total.es["weight"] = [rnd.uniform(0.01, 0.1) for _ in edges]
+
+    G = G_total.subgraph_edges(
+        [e for e in range(len(edges)) if rnd.random() < frac], delete_vertices=False
+    )
+    clusters, clusterinfo = [], {}
+    for component in G.connected_components():
+        if len(component) < 2:
+            continue
+        C = G.induced_subgraph(component)
+        xs, ys = np.array(C.vs["x"]), np.array(C.vs["y"])
+        centre = np.argmin((xs - xs.mean()) ** 2 + (ys - ys.mean()) ** 2)
+        clusterinfo[len(clusters)] = {
+            "length": sum(C.es["weight"]),
+            "centroid_index": G_total.vs.find(id=C.vs[int(centre)]["id"]).index,
+        }
+        clusters.append(C)
+    return G_total, clusters, clusterinfo
+
+
+@pytest.mark.parametrize("seed", range(30))
+@pytest.mark.parametrize("full_run", [False, True])
+def test_clusterpairs_match_baseline(seed, full_run):
+    G_total, clusters, clusterinfo = make_city(seed)
+    expected = baseline_clusterpairs(G_total, clusters, clusterinfo, full_run)
+    result = clusterpairs_by_distance(
+        G_total, G_total, clusters, clusterinfo, True, False, full_run
+    )
+    assert [pair[:2] for pair in result] == [pair[:2] for pair in expected]
+    assert [pair[2] for pair in result] == pytest.approx(
+        [pair[2] for pair in expected], rel=1e-12
+    )
+
+
+def test_way_back_summed_in_the_other_order():
+    # 0.3 + 0.2 + 0.1 == 0.6 but 0.1 + 0.2 + 0.3 == 0.6000000000000001
+    G_total = ig.Graph(n=6, edges=[(0, 1), (1, 2), (2, 3), (3, 4), (0, 5)])
+    G_total.vs["id"] = [10, 11, 12, 13, 14, 15]
+    G_total.es["weight"] = [0.1, 0.2, 0.3, 1.0, 1.0]
+    clusters = [G_total.induced_subgraph([3, 4]), G_total.induced_subgraph([0, 5])]
+    clusterinfo = {
+        0: {"length": 1.0, "centroid_index": 3},
+        1: {"length": 1.0, "centroid_index": 0},
+    }
+    result = clusterpairs_by_distance(
+        G_total, G_total, clusters, clusterinfo, True, False, False
+    )
+    assert [pair[:2] for pair in result] == [[(0, 1), (13, 10)]]
+    assert result[0][2] == pytest.approx(0.6)
@@ -0,0 +1,82 @@
+import random
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts.functions import ContractedGraph, poipair_arrays
+
+
+def make_streets(seed, n=8, chain=3):
+    """Grid of streets, each a chain of degree-2 vertices, with random
+    weights, a few streets missing, a detached street, a loop and a parallel
+    edge.
+    """
+    rnd = random.Random(seed)
+    edges = []
+    vcount = n * n
+    for i in range(n):
+        for j in range(n):
+            for di, dj in [(1, 0), (0, 1)]:
+                if i + di >= n or j + dj >= n or rnd.random() < 0.1:
+                    continue
+                path = [i * n + j] + list(range(vcount, vcount + chain))
+                path.append((i + di) * n + j + dj)
+                vcount += chain
+                edges += list(zip(path[:-1], path[1:]))
+    edges += [(vcount, vcount + 1), (vcount + 1, vcount + 2)]  # Detached
+    edges += [(0, 0), edges[0]]  # Loop and parallel edge
+    G = ig.Graph(n=vcount + 3, edges=edges)
+    G.vs["id"] = [10**6 + 3 * v for v in range(G.vcount())]
+    G.es["weight"] = [rnd.uniform(5, 50) for _ in edges]
+    return G
+
+
+def check_path(G, path, source, target, distance):
+    """path is a walk in G from source to target as long as distance."""
+    weights = {}
+    for (u, v), weight in zip(G.get_edgelist(), G.es["weight"]):
+        key = (min(u, v), max(u, v))
+        weights[key] = min(weights.get(key, np.inf), weight)
+    assert path[0] == source and path[-1] == target
+    length = sum(weights[min(u, v), max(u, v)] for u, v in zip(path[:-1], path[1:]))
+    assert length == pytest.approx(distance, rel=1e-9)
+
+
+@pytest.mark.filterwarnings("ignore:Couldn't reach some vertices")
+@pytest.mark.parametrize("seed", range(5))
+def test_distances_and_paths_match_graph(seed):
+    G = make_streets(seed)
+    rnd = random.Random(seed)
+    keep = rnd.sample(range(G.vcount() - 3), 19) + [G.vcount() - 1]
+    contracted = ContractedGraph(G, keep)
+    assert contracted.H.vcount() < G.vcount()
+
+    expected = np.array(G.distances(source=keep, target=keep, weights="weight"))
+    dist = contracted.distance_matrix(keep, keep)
+    assert np.array_equal(np.isinf(dist), np.isinf(expected))
+    finite = np.isfinite(expected)
+    assert dist[finite] == pytest.approx(expected[finite], rel=1e-9)
+
+    for source in keep[:5]:
+        for k, target in enumerate(keep):
+            path = contracted.get_shortest_path(source, target)
+            if np.isinf(expected[keep.index(source), k]):
+                assert len(path) == 0
+            else:
+                check_path(
+                    G, path.tolist(), source, target, dist[keep.index(source), k]
+                )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_poipair_arrays_on_contracted_graph(seed):
+    G = make_streets(seed)
+    keep = random.Random(seed).sample(range(G.vcount()), 25)
+    pois = G.vs[keep]["id"]
+    sources, targets, dist = poipair_arrays(G, G, pois)
+    result = poipair_arrays(G, G, pois, ContractedGraph(G, keep))
+    assert sorted(zip(result[0].tolist(), result[1].tolist())) == sorted(
+        zip(sources.tolist(), targets.tolist())
+    )
+    assert np.sort(result[2]) == pytest.approx(np.sort(dist), rel=1e-9)
@@ -0,0 +1,96 @@
+import random
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts.functions import (
+    ContractionHierarchy,
+    contraction_hierarchy,
+    poipair_arrays,
+)
+
+
+def make_streets(seed, n=10):
+    """Grid street graph with random weights, a few streets missing, some
+    split by degree-2 vertices, a detached street, a loop and a parallel edge.
+    """
+    rnd = random.Random(seed)
+    edges = []
+    vcount = n * n
+    for i in range(n):
+        for j in range(n):
+            for di, dj in [(1, 0), (0, 1)]:
+                if i + di >= n or j + dj >= n or rnd.random() < 0.1:
+                    continue
+                if rnd.random() < 0.3:
+                    edges += [(i * n + j, vcount), (vcount, (i + di) * n + j + dj)]
+                    vcount += 1
+                else:
+                    edges.append((i * n + j, (i + di) * n + j + dj))
+    edges += [(vcount, vcount + 1), (vcount + 1, vcount + 2)]  # Detached
+    edges += [(0, 0), edges[0]]  # Loop and parallel edge
+    G = ig.Graph(n=vcount + 3, edges=edges)
+    G.vs["id"] = [10**5 + 7 * v for v in range(G.vcount())]
+    G.es["weight"] = [rnd.uniform(5, 50) for _ in edges]
+    return G
+
+
+def path_length(G, path):
+    weights = {}
+    for (u, v), weight in zip(G.get_edgelist(), G.es["weight"]):
+        key = (min(u, v), max(u, v))
+        weights[key] = min(weights.get(key, np.inf), weight)
+    return sum(weights[min(u, v), max(u, v)] for u, v in zip(path[:-1], path[1:]))
+
+
+@pytest.mark.filterwarnings("ignore:Couldn't reach some vertices")
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("max_searches", [1024, 2])
+def test_distances_and_paths_match_graph(seed, max_searches):
+    G = make_streets(seed)
+    ch = ContractionHierarchy(ContractionHierarchy.build(G).arrays, max_searches)
+    rnd = random.Random(seed)
+    sources = rnd.sample(range(G.vcount() - 3), 15) + [G.vcount() - 2]
+    targets = rnd.sample(range(G.vcount() - 3), 30) + [G.vcount() - 1]
+
+    expected = np.array(G.distances(source=sources, target=targets, weights="weight"))
+    dist = ch.distance_matrix(sources, targets)
+    assert np.array_equal(np.isinf(dist), np.isinf(expected))
+    finite = np.isfinite(expected)
+    assert dist[finite] == pytest.approx(expected[finite], rel=1e-9)
+
+    for i, source in enumerate(sources[:6]):
+        for k, target in enumerate(targets):
+            path = ch.get_shortest_path(source, target).tolist()
+            if np.isinf(expected[i, k]):
+                assert path == []
+            else:
+                assert path[0] == source and path[-1] == target
+                assert path_length(G, path) == pytest.approx(expected[i, k], rel=1e-9)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_poipair_arrays_on_hierarchy(seed):
+    G = make_streets(seed)
+    pois = G.vs[random.Random(seed).sample(range(G.vcount()), 25)]["id"]
+    sources, targets, dist = poipair_arrays(G, G, pois)
+    result = poipair_arrays(G, G, pois, ContractionHierarchy.build(G))
+    assert sorted(zip(result[0].tolist(), result[1].tolist())) == sorted(
+        zip(sources.tolist(), targets.tolist())
+    )
+    assert np.sort(result[2]) == pytest.approx(np.sort(dist), rel=1e-9)
+
+
+def test_persisted_hierarchy_is_reused_and_corrupt_file_rebuilt(tmp_path):
+    G = make_streets(0)
+    ch = contraction_hierarchy(tmp_path, "city", "carall", G)
+    path = tmp_path / "city_carall_ch.npz"
+    loaded = contraction_hierarchy(tmp_path, "city", "carall", G)
+    for key, array in ch.arrays.items():
+        assert np.array_equal(loaded.arrays[key], array)
+    path.write_bytes(path.read_bytes()[:100])
+    rebuilt = contraction_hierarchy(tmp_path, "city", "carall", G)
+    assert rebuilt.distance_matrix([0, 5], [7, 9]) == pytest.approx(
+        np.array(G.distances(source=[0, 5], target=[7, 9], weights="weight"))
+    )
@@ -0,0 +1,125 @@
+import itertools
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts.functions import (
+    add_greedy_triangulation_edges,
+    candidate_poipairs,
+)
+
+
+def random_points(seed, n=60):
+    return np.random.default_rng(seed).uniform(0, 1, (n, 2))
+
+
+def collinear_points(n=20):
+    t = np.linspace(0, 1, n)
+    return np.column_stack((t, 0.5 * t + 0.1))
+
+
+def grid_points(n=7):
+    """Square grid: many equal distances and collinear triples."""
+    return np.array(list(itertools.product(range(n), range(n))), dtype=float)
+
+
+def duplicate_points(seed):
+    """Random points, some of them repeated at the same coordinates."""
+    points = random_points(seed, 40)
+    return np.concatenate((points, points[::5]))
+
+
+def mixed_points(seed):
+    """Random points plus a collinear run through them."""
+    return np.concatenate((random_points(seed, 40), collinear_points(15)))
+
+
+POINT_SETS = {
+    "random": random_points(0),
+    "random_other_seed": random_points(1),
+    "collinear": collinear_points(),
+    "two_points": random_points(2, 2),
+    "three_collinear": collinear_points(3),
+    "grid": grid_points(),
+    "duplicates": duplicate_points(3),
+    "random_and_collinear": mixed_points(4),
+}
+
+
+def make_graph(points):
+    """Graph without edges on the points; vertex ids differ from indices."""
+    G = ig.Graph(n=len(points))
+    G.vs["x"] = points[:, 0].tolist()
+    G.vs["y"] = points[:, 1].tolist()
+    G.vs["id"] = [1000 + 3 * i for i in range(len(points))]
+    return G
+
+
+def make_poipairs(G, seed=None):
+    """All pairs in ascending order of distance. With a seed, distances are
+    stretched by random detour factors as routed distances would be.
+    """
+    points = np.column_stack((G.vs["x"], G.vs["y"]))
+    pairs = list(itertools.combinations(range(G.vcount()), 2))
+    first, second = np.array(pairs).T
+    dist = np.hypot(*(points[first] - points[second]).T)
+    if seed is not None:
+        dist *= np.random.default_rng(seed).uniform(1, 1.5, len(dist))
+    order = np.argsort(dist, kind="stable")
+    ids = G.vs["id"]
+    return [((ids[first[i]], ids[second[i]]), float(dist[i])) for i in order]
+
+
+def triangulate(G, poipairs, **kwargs):
+    GT = G.copy()
+    add_greedy_triangulation_edges(GT, poipairs, **kwargs)
+    return sorted(zip(GT.get_edgelist(), GT.es["weight"]))
+
+
+@pytest.mark.parametrize("name", POINT_SETS)
+@pytest.mark.parametrize("detours", [None, 7])
+@pytest.mark.parametrize("candidates", ["delaunay", "knn", "delaunay+knn"])
+def test_pruned_candidates_match_all(name, detours, candidates):
+    G = make_graph(POINT_SETS[name])
+    poipairs = make_poipairs(G, detours)
+    expected = triangulate(G, poipairs, candidates="all")
+    result = triangulate(G, poipairs, candidates=candidates, k=3, verify=True)
+    assert result == expected
+
+
+@pytest.mark.parametrize("candidates", ["delaunay", "knn", "delaunay+knn"])
+def test_pruned_candidates_match_all_with_existing_edges(candidates):
+    G = make_graph(random_points(5))
+    G.add_edges([(0, 1), (2, 3), (4, 5)], attributes={"weight": [0.0] * 3})
+    poipairs = make_poipairs(G, 11)
+    expected = triangulate(G, poipairs, candidates="all")
+    result = triangulate(G, poipairs, candidates=candidates, k=3, verify=True)
+    assert result == expected
+
+
+@pytest.mark.parametrize("name", POINT_SETS)
+@pytest.mark.parametrize("mode", ["delaunay", "knn", "delaunay+knn"])
+def test_candidate_poipairs_mask(name, mode):
+    G = make_graph(POINT_SETS[name])
+    points = np.column_stack((G.vs["x"], G.vs["y"]))
+    first, second = np.array(list(itertools.combinations(range(G.vcount()), 2))).T
+    keep = candidate_poipairs(points[:, 0], points[:, 1], first, second, mode, k=3)
+    assert keep.dtype == bool and keep.shape == first.shape
+    assert keep.any()
+    if "knn" in mode:
+        # Every vertex keeps at least one of its pairs
+        assert set(first[keep]) | set(second[keep]) == set(range(G.vcount()))
+
+
+@pytest.mark.parametrize("name", POINT_SETS)
+@pytest.mark.parametrize("batch_size", [1, 7])
+def test_batch_size_does_not_change_result(name, batch_size):
+    G = make_graph(POINT_SETS[name])
+    poipairs = make_poipairs(G, 13)
+    expected = triangulate(G, poipairs, candidates="all")
+    for candidates in ["all", "delaunay+knn"]:
+        result = triangulate(
+            G, poipairs, candidates=candidates, k=3, verify=True, batch_size=batch_size
+        )
+        assert result == expected
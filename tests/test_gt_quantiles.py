@@ -0,0 +1,112 @@
+import math
+import random
+from collections import namedtuple
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts.functions import greedy_triangulation_quantiles
+
+Point = namedtuple("Point", "x y")
+
+
+def ccw(A, B, C):
+    return (C.y - A.y) * (B.x - A.x) > (B.y - A.y) * (C.x - A.x)
+
+
+def baseline_intersects(GT, A, B):
+    """new_edge_intersects as it was: AB against every edge of GT."""
+    for e in GT.es:
+        C = Point(e.source_vertex["x"], e.source_vertex["y"])
+        D = Point(e.target_vertex["x"], e.target_vertex["y"])
+        if A in (C, D) or B in (C, D):
+            continue
+        if ccw(A, C, D) != ccw(B, C, D) and ccw(A, B, C) != ccw(A, B, D):
+            return True
+    return False
+
+
+def baseline_triangulation(GT, poipairs):
+    for (id1, id2), distance in poipairs:
+        i, j = GT.vs.find(id=id1).index, GT.vs.find(id=id2).index
+        A = Point(GT.vs[i]["x"], GT.vs[i]["y"])
+        B = Point(GT.vs[j]["x"], GT.vs[j]["y"])
+        if not baseline_intersects(GT, A, B):
+            GT.add_edge(i, j, weight=distance)
+    return GT
+
+
+def baseline_greedy_triangulation(GT, poipairs, prune_quantile, prune_measure):
+    """greedy_triangulation as it was, triangulating again for each quantile."""
+    GT = baseline_triangulation(GT, poipairs)
+    if prune_measure == "betweenness":
+        BW = GT.edge_betweenness(directed=False, weights="weight")
+        qt = np.quantile(BW, 1 - prune_quantile)
+        sub_edges = []
+        for c, e in enumerate(GT.es):
+            if BW[c] >= qt:
+                sub_edges.append(c)
+            GT.es[c]["bw"] = BW[c]
+            GT.es[c]["width"] = math.sqrt(BW[c] + 1) * 0.5
+        return GT.subgraph_edges(sub_edges)
+    if prune_measure == "closeness":
+        CC = GT.closeness(vertices=None, weights="weight")
+        qt = np.quantile(CC, 1 - prune_quantile)
+        sub_nodes = []
+        for c, v in enumerate(GT.vs):
+            if CC[c] >= qt:
+                sub_nodes.append(c)
+            GT.vs[c]["cc"] = CC[c]
+        return GT.induced_subgraph(sub_nodes)
+    # random: the order of the edges of the whole GT, with a constant seed
+    random.seed(0)
+    edgeorder = random.sample(range(GT.ecount()), k=GT.ecount())
+    ind = np.quantile(np.arange(len(edgeorder)), prune_quantile, method="lower") + 1
+    return GT.subgraph_edges(edgeorder[:ind])
+
+
+def make_pois(seed, n=30):
+    """POI graph without edges, and all its pairs in ascending order of their
+    straight distance stretched by random detour factors.
+    """
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 1000, (n, 2))
+    G = ig.Graph(n=n)
+    G.vs["x"] = points[:, 0].tolist()
+    G.vs["y"] = points[:, 1].tolist()
+    G.vs["id"] = [300 + 11 * i for i in range(n)]
+    first, second = np.triu_indices(n, 1)
+    dist = np.hypot(*(points[first] - points[second]).T)
+    dist *= rng.uniform(1, 1.5, len(dist))
+    order = np.argsort(dist, kind="stable")
+    ids = G.vs["id"]
+    poipairs = [((ids[first[i]], ids[second[i]]), float(dist[i])) for i in order]
+    return G, poipairs
+
+
+def described(GT):
+    ids = GT.vs["id"]
+    edges = sorted(
+        (min(ids[u], ids[v]), max(ids[u], ids[v]), w)
+        for (u, v), w in zip(GT.get_edgelist(), GT.es["weight"])
+    )
+    return sorted(ids), edges
+
+
+QUANTILES = [0.025, 0.1, 0.3, 0.5, 0.75, 1]
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("prune_measure", ["betweenness", "closeness", "random"])
+def test_quantiles_match_baseline(seed, prune_measure):
+    G, poipairs = make_pois(seed)
+    GTs = greedy_triangulation_quantiles(G.copy(), poipairs, QUANTILES, prune_measure)
+    assert len(GTs) == len(QUANTILES)
+    for GT, prune_quantile in zip(GTs, QUANTILES):
+        expected = baseline_greedy_triangulation(
+            G.copy(), poipairs, prune_quantile, prune_measure
+        )
+        assert described(GT) == described(expected)
+        if prune_measure == "betweenness":
+            assert sorted(GT.es["bw"]) == pytest.approx(sorted(expected.es["bw"]))
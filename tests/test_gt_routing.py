@@ -0,0 +1,74 @@
+import random
+
+import igraph as ig
+import pytest
+
+from cicloapi.backend.models.scripts.functions import (
+    PathCache,
+    greedy_triangulation_routing,
+    mst_routing,
+)
+
+
+def baseline_route(G, G_abstract):
+    """The routing of greedy_triangulation_routing as it was: the shortest
+    path of every abstract edge routed again for each quantile.
+    """
+    indices = set()
+    for e in G_abstract.es:
+        source = G.vs.find(id=e.source_vertex["id"]).index
+        target = G.vs.find(id=e.target_vertex["id"]).index
+        indices |= set(
+            G.get_shortest_paths(source, target, weights="weight", output="vpath")[0]
+        )
+    return G.induced_subgraph(indices)
+
+
+def make_city(seed, n=15, npois=25):
+    """Grid street graph with jittered coordinates and random weights."""
+    rnd = random.Random(seed)
+    edges = [
+        (i * n + j, (i + di) * n + j + dj)
+        for i in range(n)
+        for j in range(n)
+        for di, dj in [(1, 0), (0, 1)]
+        if i + di < n and j + dj < n and rnd.random() < 0.9
+    ]
+    G = ig.Graph(n=n * n, edges=edges)
+    G.vs["id"] = [4000 + 7 * v for v in range(n * n)]
+    G.vs["x"] = [100 * (v // n) + rnd.uniform(-20, 20) for v in range(n * n)]
+    G.vs["y"] = [100 * (v % n) + rnd.uniform(-20, 20) for v in range(n * n)]
+    G.es["weight"] = [rnd.uniform(80, 160) for _ in edges]
+    return G, rnd.sample(G.vs["id"], npois)
+
+
+def described(G):
+    ids = G.vs["id"]
+    return sorted(ids), sorted(
+        (min(ids[u], ids[v]), max(ids[u], ids[v])) for u, v in G.get_edgelist()
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("prune_measure", ["betweenness", "random"])
+def test_routed_quantiles_match_baseline(seed, prune_measure):
+    G, pois = make_city(seed)
+    quantiles = [0.1, 0.4, 0.7, 1]
+    GTs, GT_abstracts = greedy_triangulation_routing(
+        G, G, pois, quantiles, prune_measure
+    )
+    assert len(GTs) == len(GT_abstracts) == len(quantiles)
+    for GT, GT_abstract in zip(GTs, GT_abstracts):
+        assert described(GT) == described(baseline_route(G, GT_abstract))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_shared_path_cache_matches_fresh_routing(seed):
+    G, pois = make_city(seed)
+    path_cache = PathCache(G)
+    GTs, _ = greedy_triangulation_routing(G, G, pois, [0.5, 1], path_cache=path_cache)
+    MST, MST_abstract = mst_routing(G, G, pois, path_cache)
+    assert described(MST) == described(mst_routing(G, G, pois)[0])
+    assert described(MST) == described(baseline_route(G, MST_abstract))
+    fresh, _ = greedy_triangulation_routing(G, G, pois, [0.5, 1])
+    assert [described(GT) for GT in GTs] == [described(GT) for GT in fresh]
@@ -0,0 +1,87 @@
+import random
+
+import igraph as ig
+import numpy as np
+import pytest
+
+from cicloapi.backend.models.scripts.functions import (
+    minimum_spanning_edges,
+    mst_routing,
+    poipairs_by_distance,
+)
+
+
+def baseline_mst_abstract(G, pois):
+    """MST_abstract of mst_routing as it was: the complete graph of the POI
+    pairs and their distances, reduced by spanning_tree.
+    """
+    indices = sorted({G.vs.find(id=poi).index for poi in pois})
+    MST_abstract = G.subgraph(indices)
+    MST_abstract.delete_edges(MST_abstract.es)
+    for (id1, id2), distance in poipairs_by_distance(G, G, pois, True):
+        MST_abstract.add_edge(
+            MST_abstract.vs.find(id=id1).index,
+            MST_abstract.vs.find(id=id2).index,
+            weight=distance,
+        )
+    return MST_abstract.spanning_tree(weights="weight")
+
+
+def make_city(seed, n=12, npois=30):
+    """Grid street graph with random weights and a detached street, with
+    pois on both, one of them twice.
+    """
+    rnd = random.Random(seed)
+    edges = [
+        (i * n + j, (i + di) * n + j + dj)
+        for i in range(n)
+        for j in range(n)
+        for di, dj in [(1, 0), (0, 1)]
+        if i + di < n and j + dj < n and rnd.random() < 0.9
+    ]
+    edges += [(n * n, n * n + 1), (n * n + 1, n * n + 2)]
+    G = ig.Graph(n=n * n + 3, edges=edges)
+    G.vs["id"] = [2000 + 3 * v for v in range(G.vcount())]
+    G.vs["x"] = [float(v // n) for v in range(G.vcount())]
+    G.vs["y"] = [float(v % n) for v in range(G.vcount())]
+    G.es["weight"] = [rnd.uniform(10, 200) for _ in edges]
+    pois = rnd.sample(G.vs["id"][: n * n], npois - 2) + G.vs["id"][n * n :: 2]
+    pois.insert(3, pois[-1])
+    return G, pois
+
+
+def described(MST_abstract):
+    ids = MST_abstract.vs["id"]
+    return [
+        (ids[u], ids[v], w)
+        for (u, v), w in zip(MST_abstract.get_edgelist(), MST_abstract.es["weight"])
+    ]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_mst_abstract_matches_spanning_tree(seed):
+    G, pois = make_city(seed)
+    MST, MST_abstract = mst_routing(G, G, pois)
+    expected = baseline_mst_abstract(G, pois)
+    assert MST_abstract.vs["id"] == expected.vs["id"]
+    assert described(MST_abstract) == described(expected)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_prim_matches_spanning_tree(seed):
+    rng = np.random.default_rng(seed)
+    n = 40
+    dist = rng.uniform(1, 100, (n, n))
+    dist = np.minimum(dist, dist.T)
+    dist[rng.random((n, n)) < 0.7] = np.inf  # Sparse, maybe disconnected
+    dist = np.minimum(dist, dist.T)
+    np.fill_diagonal(dist, np.inf)
+    parents, children = minimum_spanning_edges(dist)
+
+    first, second = np.nonzero(np.triu(np.isfinite(dist), 1))
+    H = ig.Graph(n=n, edges=np.column_stack((first, second)).tolist())
+    H.es["weight"] = dist[first, second].tolist()
+    T = H.spanning_tree(weights="weight")
+    assert sorted(map(sorted, zip(parents.tolist(), children.tolist()))) == sorted(
+        map(sorted, T.get_edgelist())
+    )
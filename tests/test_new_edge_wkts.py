@@ -0,0 +1,57 @@
+import random
+
+import igraph as ig
+import pytest
+import shapely
+from shapely.geometry import shape
+
+from cicloapi.backend.models.scripts.functions import ig_to_geojson, new_edge_wkts
+
+
+def make_nested(seed, n=12, count=5):
+    """Induced subgraphs of a jittered grid on growing vertex sets, nested
+    like the GTs of increasing quantiles.
+    """
+    rnd = random.Random(seed)
+    edges = [
+        (i * n + j, (i + di) * n + j + dj)
+        for i in range(n)
+        for j in range(n)
+        for di, dj in [(1, 0), (0, 1)]
+        if i + di < n and j + dj < n
+    ]
+    G = ig.Graph(n=n * n, edges=edges)
+    G.vs["id"] = [6000 + 13 * v for v in range(n * n)]
+    G.vs["x"] = [v // n + rnd.uniform(-0.3, 0.3) for v in range(n * n)]
+    G.vs["y"] = [v % n + rnd.uniform(-0.3, 0.3) for v in range(n * n)]
+    order = rnd.sample(range(n * n), n * n)
+    return [G.induced_subgraph(order[: (k + 1) * n * n // count]) for k in range(count)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_new_edges_match_shapely_difference(seed):
+    Gs = make_nested(seed)
+    wkts = new_edge_wkts(Gs)
+    assert len(wkts) == len(Gs)
+    previous = None
+    for G, lines in zip(Gs, wkts):
+        current = shape(ig_to_geojson(G))
+        new = shapely.union_all(shapely.from_wkt(lines))
+        if previous is None:
+            # The first graph gives all its edges, each once
+            assert sorted(lines) == sorted(line.wkt for line in current.geoms)
+            expected = current
+        else:
+            # As poi_based_generation had it: what is not in the previous graph
+            expected = current.difference(previous)
+        assert new.symmetric_difference(expected).length == pytest.approx(0, abs=1e-9)
+        previous = current
+
+
+def test_repeated_and_empty_graphs():
+    G = make_nested(0)[-1]
+    empty = G.subgraph_edges([], delete_vertices=True)
+    wkts = new_edge_wkts([G, G, empty, G])
+    assert len(wkts[0]) == G.ecount()
+    assert wkts[1] == [] and wkts[2] == []
+    assert sorted(wkts[3]) == sorted(wkts[0])
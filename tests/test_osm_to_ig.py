@@ -0,0 +1,65 @@
+import igraph as ig
+import numpy as np
+import pandas as pd
+import pytest
+
+from cicloapi.backend.models.scripts.functions import osm_to_ig
+
+
+def baseline_osm_to_ig(node, edge):
+    """osm_to_ig as it was: one vertex and edge at a time, then simplify."""
+    G = ig.Graph(directed=False)
+    for x, y, osmid in zip(node["x"], node["y"], node["osmid"]):
+        G.add_vertex(x=x, y=y, id=osmid)
+    id_dict = dict(zip(G.vs["id"], range(G.vcount())))
+    G.add_edges([[id_dict[u], id_dict[v]] for u, v in zip(edge["u"], edge["v"])])
+    for i in range(len(edge)):
+        G.es[i]["weight"] = round(edge["length"][i], 10)
+        G.es[i]["osmid"] = edge["osmid"][i]
+    G.simplify(combine_edges=max)
+    return G
+
+
+def random_tables(seed, n=60, m=250):
+    """Nodes with unsorted ids, and edges with loops, reversed and parallel
+    duplicates.
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(10**9, size=n, replace=False)
+    node = pd.DataFrame(
+        {"osmid": ids, "x": rng.uniform(size=n), "y": rng.uniform(size=n)}
+    )
+    u = rng.integers(0, n, m)
+    v = np.where(rng.random(m) < 0.05, u, rng.integers(0, n, m))
+    repeat = rng.integers(0, m, m // 3)
+    u = np.concatenate((u, v[repeat]))
+    v = np.concatenate((v, u[repeat]))
+    edge = pd.DataFrame(
+        {
+            "u": ids[u],
+            "v": ids[v],
+            "length": rng.uniform(1, 500, len(u)),
+            "osmid": rng.integers(0, 10**6, len(u)),
+        }
+    )
+    return node, edge
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_osm_to_ig_matches_baseline(seed):
+    node, edge = random_tables(seed)
+    expected = baseline_osm_to_ig(node, edge)
+    G = osm_to_ig(node, edge)
+    assert G.vcount() == expected.vcount()
+    for attribute in ["x", "y", "id"]:
+        assert G.vs[attribute] == expected.vs[attribute]
+    assert G.get_edgelist() == expected.get_edgelist()
+    for attribute in ["weight", "osmid"]:
+        assert G.es[attribute] == expected.es[attribute]
+
+
+def test_missing_endpoint_raises():
+    node, edge = random_tables(0)
+    edge.loc[3, "v"] = -1
+    with pytest.raises(ValueError):
+        osm_to_ig(node, edge)
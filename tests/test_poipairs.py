@@ -0,0 +1,57 @@
+import random
+
+import igraph as ig
+import pytest
+
+from cicloapi.backend.models.scripts.functions import poipairs_by_distance
+
+
+def baseline_poipairs_by_distance(G, G_carall, pois):
+    """poipairs_by_distance(..., return_distances=True) as it was: the paths
+    from every poi to the later ones, their weights summed.
+    """
+    indices = [G_carall.vs.find(id=poi).index for poi in pois]
+    poi_dist = {}
+    for c, v in enumerate(indices):
+        paths_n = G.get_shortest_paths(v, indices[c:], weights="weight", output="vpath")
+        paths_e = G.get_shortest_paths(v, indices[c:], weights="weight", output="epath")
+        for path_n, path_e in zip(paths_n, paths_e):
+            path_dist = sum([G.es[e]["weight"] for e in path_e])
+            if path_dist > 0:
+                poi_dist[(path_n[0], path_n[-1])] = path_dist
+    temp = sorted(poi_dist.items(), key=lambda x: x[1])
+    return [[(G.vs[p[0][0]]["id"], G.vs[p[0][1]]["id"]), p[1]] for p in temp]
+
+
+def make_city(seed, n=14, npois=30):
+    """Grid street graph with random weights and a few streets missing, plus
+    a detached street, and pois on both, one of them twice.
+    """
+    rnd = random.Random(seed)
+    edges = [
+        (i * n + j, (i + di) * n + j + dj)
+        for i in range(n)
+        for j in range(n)
+        for di, dj in [(1, 0), (0, 1)]
+        if i + di < n and j + dj < n and rnd.random() < 0.85
+    ]
+    edges += [(n * n, n * n + 1), (n * n + 1, n * n + 2)]
+    G = ig.Graph(n=n * n + 3, edges=edges)
+    G.vs["id"] = [9000 + 5 * v for v in range(G.vcount())]
+    G.es["weight"] = [rnd.uniform(10, 200) for _ in edges]
+    pois = rnd.sample(G.vs["id"][: n * n], npois - 2) + G.vs["id"][n * n :: 2]
+    pois.insert(5, pois[0])
+    return G, pois
+
+
+@pytest.mark.filterwarnings("ignore:Couldn't reach some vertices")
+@pytest.mark.parametrize("seed", range(10))
+def test_poipairs_match_baseline(seed):
+    G, pois = make_city(seed)
+    expected = baseline_poipairs_by_distance(G, G, pois)
+    result = poipairs_by_distance(G, G, pois, True)
+    assert [pair[0] for pair in result] == [pair[0] for pair in expected]
+    assert [pair[1] for pair in result] == pytest.approx(
+        [pair[1] for pair in expected], rel=1e-12
+    )
+    assert poipairs_by_distance(G, G, pois) == [pair[0] for pair in expected]
@@ -0,0 +1,39 @@
+import os
+import time
+
+from cicloapi.backend.models.scripts.functions import ResultCache
+
+
+def put_entry(cache, key, tmp_path, nbytes):
+    source = tmp_path / f"{key}.csv"
+    source.write_bytes(b"x" * nbytes)
+    cache.put(key, [source], [("segment", key)])
+
+
+def test_stray_files_are_not_entries(tmp_path):
+    cache = ResultCache(tmp_path / "cache", 10**6, 3600)
+    put_entry(cache, "a", tmp_path, 10)
+    (cache.root / "notes.txt").write_text("not an entry")
+    assert cache.stats()["entries"] == 1
+    folder, segments = cache.get("a")
+    assert segments == [("segment", "a")]
+    assert (folder / "a.csv").read_bytes() == b"x" * 10
+
+
+def test_missing_root_is_empty(tmp_path):
+    cache = ResultCache(tmp_path / "missing", 10**6, 3600)
+    assert cache.stats()["entries"] == 0
+    cache.evict()
+    assert cache.get("a") is None
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = ResultCache(tmp_path / "cache", 300, 3600)
+    put_entry(cache, "a", tmp_path, 100)
+    put_entry(cache, "b", tmp_path, 100)
+    past = time.time() - 60
+    os.utime(cache.root / "a", (past, past))
+    cache.get("a")  # Now b is the least recently used
+    put_entry(cache, "c", tmp_path, 100)
+    assert sorted(p.name for p in cache.root.iterdir()) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
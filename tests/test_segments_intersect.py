@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Point
+
+from cicloapi.backend.models.scripts.functions import (
+    SegmentIndex,
+    segments_intersect,
+    segments_intersect_array,
+)
+
+
+def random_segments(seed, n=300):
+    return np.random.default_rng(seed).uniform(0, 1, (n, 4))
+
+
+def scalar_crossings(query, segments):
+    A, B = Point(query[:2]), Point(query[2:])
+    return np.array(
+        [segments_intersect(A, B, Point(s[:2]), Point(s[2:])) for s in segments]
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_scalar_array_and_shapely_agree(seed):
+    segments = random_segments(seed)
+    for query in segments[:20]:
+        expected = np.array(
+            [
+                LineString([query[:2], query[2:]]).crosses(LineString([s[:2], s[2:]]))
+                for s in segments
+            ]
+        )
+        expected[(segments == query).all(axis=1)] = False
+        assert (scalar_crossings(query, segments) == expected).all()
+        assert (segments_intersect_array(*query, *segments.T) == expected).all()
+
+
+def test_shared_endpoint_is_not_a_crossing():
+    assert not segments_intersect_array(0, 0, 1, 1, 1, 1, 2, 0)
+    assert not segments_intersect(Point(0, 0), Point(1, 1), Point(1, 1), Point(2, 0))
+
+
+def test_far_apart_colinear_segments_do_not_cross():
+    # Rounding makes the orientation tests of these colinear points disagree
+    t = np.linspace(0, 1, 20)
+    x, y = t, 0.5 * t + 0.1
+    pairs = [(i, j) for i in range(20) for j in range(i + 1, 20)]
+    segments = np.array([(x[i], y[i], x[j], y[j]) for i, j in pairs])
+    for (i, j), query in zip(pairs, segments):
+        apart = np.array([max(a, b) < i or min(a, b) > j for a, b in pairs])
+        assert not segments_intersect_array(*query, *segments[apart].T).any()
+        assert not scalar_crossings(query, segments[apart]).any()
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("rebuild_size", [16, 256])
+def test_index_matches_brute_force(seed, rebuild_size):
+    segments = random_segments(seed, 600)
+    index = SegmentIndex(rebuild_size=rebuild_size)
+    for start in range(0, 500, 50):
+        index.add(segments[start : start + 50])
+    queries = segments[500:]
+    for count in [None, 120, 500]:
+        q, s = index.crossings(queries, count)
+        indexed = segments[: 500 if count is None else count]
+        expected = [
+            np.flatnonzero(segments_intersect_array(*query, *indexed.T))
+            for query in queries
+        ]
+        found = [np.sort(s[q == i]) for i in range(len(queries))]
+        assert all((a == b).all() for a, b in zip(found, expected))
+    assert index.tree_size > 0
@@ -0,0 +1,61 @@
+import igraph as ig
+import pytest
+
+from cicloapi.backend.models.scripts.functions import (
+    delete_overlaps,
+    forget_vertex_id_map,
+    vertex_index,
+    vertex_indices,
+)
+
+
+def path_graph(ids):
+    G = ig.Graph(n=len(ids), edges=[(i, i + 1) for i in range(len(ids) - 1)])
+    G.vs["id"] = list(ids)
+    G.es["weight"] = [1.0] * G.ecount()
+    return G
+
+
+def find(G, vertex_id):
+    return G.vs.find(id=vertex_id).index
+
+
+def test_lookup_matches_find():
+    G = path_graph([50, 10, 40, 10, 30])
+    for vertex_id in [50, 10, 40, 30]:
+        assert vertex_index(G, vertex_id) == find(G, vertex_id)
+    assert vertex_indices(G, [30, 10, 50]) == [4, 1, 0]
+    with pytest.raises(ValueError):
+        vertex_index(G, 20)
+
+
+def test_ids_changed_in_place():
+    G = path_graph([1, 2, 3, 4])
+    vertex_index(G, 1)
+    G.vs["id"] = [4, 3, 2, 1]
+    assert vertex_index(G, 1) == 3
+    G.vs["id"] = [5, 6, 7, 8]
+    forget_vertex_id_map(G)
+    assert vertex_indices(G, [8, 5]) == [3, 0]
+
+
+def test_vertex_swapped_for_another():
+    G = path_graph([1, 2, 3, 4])
+    vertex_index(G, 1)
+    G.delete_vertices([0])
+    G.add_vertex(id=9)
+    forget_vertex_id_map(G)
+    assert vertex_index(G, 9) == 3
+    assert vertex_index(G, 2) == 0
+
+
+def test_delete_overlaps_keeps_lookups_right():
+    G_res = path_graph([1, 2, 3, 4, 5])
+    G_orig = path_graph([1, 2, 3])
+    vertex_indices(G_res, [1, 2, 3, 4, 5])
+    delete_overlaps(G_res, G_orig)
+    assert G_res.vs["id"] == [3, 4, 5]
+    for vertex_id in [3, 4, 5]:
+        assert vertex_index(G_res, vertex_id) == find(G_res, vertex_id)
+    with pytest.raises(ValueError):
+        vertex_index(G_res, 1)